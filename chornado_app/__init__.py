@@ -4,7 +4,7 @@ from flask_wtf.csrf import CSRFProtect
 
 csrf = CSRFProtect()
 
-def create_app():
+def create_app(test_config=None):
     '''Creates flask application session'''
 
     app = Flask(__name__, instance_relative_config=True)
@@ -19,30 +19,180 @@ def create_app():
     db_internal = environ.get('DBINTERNAL')
     # Web address of fly.io DB
     db_web = environ.get('DBWEB')
+    # Import path of shared user cache backend, process-local if unset
+    user_cache_backend = environ.get('USER_CACHE_BACKEND')
+    # Seconds a logged in user is cached before reloading from DB
+    user_cache_ttl = int(environ.get('USER_CACHE_TTL', 60))
+    # Import path of shared template fragment cache backend, process-local if unset
+    fragment_cache_backend = environ.get('FRAGMENT_CACHE_BACKEND')
+    # Password hash method and work factor
+    hash_method = environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+    # Password hashing processes per worker, 0 to hash inline
+    hash_workers = int(environ.get('PASSWORD_HASH_WORKERS', 2))
+    # Password hashes allowed to run or wait per worker
+    hash_queue = int(environ.get('PASSWORD_HASH_QUEUE', 8))
+    # Notification event backend: postgres (LISTEN/NOTIFY) or local
+    events_backend = environ.get('EVENTS_BACKEND', 'postgres')
+    # Deployed release, so page ETags change with templates. Set by fly.io
+    release = environ.get('FLY_IMAGE_REF', '')
+    # Gunicorn worker processes per machine, shared with gunicorn.conf.py
+    web_workers = int(environ.get('WEB_CONCURRENCY', 2))
+    # Gunicorn worker class: gevent, or sync/gthread for a request per thread
+    web_worker_class = environ.get('WEB_WORKER_CLASS', 'gevent')
+    # Concurrent requests per gevent worker, matching hard_limit in fly.toml
+    web_worker_connections = int(environ.get('WEB_WORKER_CONNECTIONS', 25))
+    # Threads per sync/gthread worker
+    web_threads = int(environ.get('WEB_THREADS', 1))
+    # Machines running web workers against the same database
+    web_machines = int(environ.get('WEB_MACHINES', 1))
+    # Connections per worker pool, sized from the worker model if unset
+    db_pool_size = int(environ.get('DB_POOL_SIZE', 0))
+    # Seconds before a pooled connection is replaced
+    db_pool_recycle = int(environ.get('DB_POOL_RECYCLE', 1800))
+    # Seconds a request waits for a pooled connection before failing
+    db_pool_timeout = int(environ.get('DB_POOL_TIMEOUT', 10))
+    # Set to 1 when connecting through PgBouncer in transaction mode
+    db_pgbouncer = environ.get('DB_PGBOUNCER') == '1'
+    # Direct (not PgBouncer) connection string for the event listener
+    events_database_uri = environ.get('EVENTS_DATABASE_URI')
+    # Bearer token for /internal/pool stats, disabled if unset
+    metrics_token = environ.get('METRICS_TOKEN')
+    # max_connections of the PostgreSQL server
+    db_max_connections = int(environ.get('DB_MAX_CONNECTIONS', 100))
+    # Days notifications are kept before purge-notifications deletes them
+    notification_ttl_days = int(environ.get('NOTIFICATION_TTL_DAYS', 30))
+    # Directory of precompiled template bytecode, filled at build time by
+    # precompile-templates. Templates are compiled in memory if unset
+    template_cache_dir = environ.get('TEMPLATE_CACHE_DIR')
+    # Pooled connections each web worker opens before passing health checks
+    db_warm_connections = int(environ.get('DB_WARM_CONNECTIONS', 2))
+    # Milliseconds of imports allowed at startup, checked by check-startup
+    import_time_budget = int(environ.get('IMPORT_TIME_BUDGET_MS', 1000))
+    # Set to 1 to count SQL queries per request
+    query_stats = environ.get('QUERY_STATS') == '1'
 
     app.config.from_mapping(
         SECRET_KEY=secret_key,
-        SQLALCHEMY_ENGINE_OPTIONS={"pool_pre_ping": True},
+        # Pool options are filled in by init_pool()
+        SQLALCHEMY_ENGINE_OPTIONS={},
         # Connection string for development
         # SQLALCHEMY_DATABASE_URI=f'postgresql://{dblogin}:{dbpassword}@{db_web}:5432',
         # Connection string for production
         SQLALCHEMY_DATABASE_URI=f'postgresql://{dblogin}:{dbpassword}@{db_internal}:5432',
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        QUERY_STATS=query_stats,
+        USER_CACHE_BACKEND=user_cache_backend,
+        USER_CACHE_SIZE=1024,
+        USER_CACHE_TTL=user_cache_ttl,
+        FRAGMENT_CACHE_BACKEND=fragment_cache_backend,
+        FRAGMENT_CACHE_SIZE=512,
+        # Fragments are keyed on the family data version, so this only
+        # limits how long unused fragments are kept
+        FRAGMENT_CACHE_TTL=3600,
+        PASSWORD_HASH_METHOD=hash_method,
+        PASSWORD_HASH_WORKERS=hash_workers,
+        PASSWORD_HASH_QUEUE=hash_queue,
+        EVENTS_BACKEND=events_backend,
+        EVENTS_DATABASE_URI=events_database_uri,
+        # Seconds before an event stream is closed for the browser to reconnect
+        EVENTS_STREAM_TIMEOUT=300,
+        ETAG_SALT=release,
+        WEB_WORKERS=web_workers,
+        WEB_WORKER_CLASS=web_worker_class,
+        WEB_WORKER_CONNECTIONS=web_worker_connections,
+        WEB_THREADS=web_threads,
+        WEB_MACHINES=web_machines,
+        DB_POOL_SIZE=db_pool_size,
+        DB_MAX_OVERFLOW=0,
+        DB_POOL_RECYCLE=db_pool_recycle,
+        DB_POOL_TIMEOUT=db_pool_timeout,
+        DB_PGBOUNCER=db_pgbouncer,
+        # Greenlets wait for a pooled connection beyond this many
+        DB_GREEN_POOL_LIMIT=10,
+        DB_MAX_CONNECTIONS=db_max_connections,
+        # Connections left for the scheduler, release commands and psql
+        DB_RESERVED_CONNECTIONS=5,
+        METRICS_TOKEN=metrics_token,
+        NOTIFICATION_TTL_DAYS=notification_ttl_days,
+        TEMPLATE_CACHE_DIR=template_cache_dir,
+        DB_WARM_CONNECTIONS=db_warm_connections,
+        IMPORT_TIME_BUDGET_MS=import_time_budget
     )
 
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+
     try:
         makedirs(app.instance_path)
     except OSError:
         pass
 
     csrf.init_app(app)
-    
+
+    from chornado_app.passwords import init_password_hashing
+    init_password_hashing(app)
+
+    if app.config['QUERY_STATS']:
+        from chornado_app.query_stats import init_query_stats
+        init_query_stats(app)
+
+    from chornado_app.pool import init_pool
+    init_pool(app)
+
     from chornado_app.sql_models import db
     db.init_app(app)
 
+    from chornado_app.startup import init_startup
+    init_startup(app)
+
+    from chornado_app.assets import init_assets
+    init_assets(app)
+
+    from chornado_app.events import init_events
+    init_events(app)
+
+    from chornado_app.migrations import upgrade_db_command
+    app.cli.add_command(upgrade_db_command)
+
+    from chornado_app.query_stats import explain_queries_command
+    app.cli.add_command(explain_queries_command)
+
+    from chornado_app.scheduler import run_scheduler_command
+    app.cli.add_command(run_scheduler_command)
+
+    from chornado_app.points import reconcile_points_command, stress_points_command
+    app.cli.add_command(reconcile_points_command)
+    app.cli.add_command(stress_points_command)
+
+    from chornado_app.services import check_budgets_command
+    app.cli.add_command(check_budgets_command)
+
+    from chornado_app.notifications import purge_notifications_command
+    app.cli.add_command(purge_notifications_command)
+
+    from chornado_app.transfer import export_family_command, import_family_command
+    app.cli.add_command(export_family_command)
+    app.cli.add_command(import_family_command)
+
+    from chornado_app.benchmark import benchmark_command
+    app.cli.add_command(benchmark_command)
+
+    from chornado_app.startup import precompile_templates_command, check_startup_command
+    app.cli.add_command(precompile_templates_command)
+    app.cli.add_command(check_startup_command)
+
+    from chornado_app.assets import build_assets_command
+    app.cli.add_command(build_assets_command)
+
     from chornado_app.auth import login_manager
     login_manager.init_app(app)
 
+    from chornado_app.cache import make_cache
+    app.extensions['user_cache'] = make_cache(app, 'USER_CACHE')
+
+    from chornado_app.fragments import init_fragment_cache
+    init_fragment_cache(app)
+
     from .auth import auth_bp
     app.register_blueprint(auth_bp)
 
@@ -55,4 +205,7 @@ def create_app():
     from .children import child_bp
     app.register_blueprint(child_bp)
 
+    from .api import api_bp
+    app.register_blueprint(api_bp)
+
     return app
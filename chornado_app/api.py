@@ -0,0 +1,229 @@
+from functools import wraps
+from flask import Blueprint, jsonify, request
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+
+from .sql_models import (Child, Reward, ChildNotification, ParentNotification)
+from .services import (complete_chore, approve_chore, reject_chore,
+    remove_assigned_chore, purchase_reward, deliver_reward, acknowledge_notification,
+    RewardNotFound)
+from .helpers import (load_dashboard, load_notifications, load_chore_pages,
+    family_version)
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+def api_error(status, message):
+    """JSON error response
+    Args: (status, message)"""
+
+    return jsonify({'error': message}), status
+
+def role_required(role):
+    """Limit API route to logged in users of one type
+    Args: (role)"""
+
+    def decorator(view):
+        @wraps(view)
+        def decorated_view(*args, **kwargs):
+            if not current_user.is_authenticated:
+                return api_error(401, 'Login required')
+            if current_user.type != role:
+                return api_error(403, f'Only {role} users can use this resource')
+            return view(*args, **kwargs)
+        return decorated_view
+    return decorator
+
+def resource(data):
+    """JSON response with an ETag, answered with 304 Not Modified when the
+    client already has the same data
+    Args: (data)"""
+
+    response = jsonify(data)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.add_etag()
+    return response.make_conditional(request)
+
+def chore_data(chore):
+    return {'id': chore.id, 'name': chore.name, 'points': chore.points,
+        'state': chore.state}
+
+def notification_data(notification):
+    return {'id': notification.id, 'type': notification.type,
+        'message': notification.message, 'chore_id': notification.chore_id,
+        'reward_id': notification.reward_id}
+
+def notification_page(model, owner_id, after=None):
+    """A page of notifications with the id to request the next page after
+    Args: (model, owner_id, after)"""
+
+    notifications, next_id = load_notifications(model, owner_id, after)
+    return {'notifications': [notification_data(notification)
+            for notification in notifications],
+        'next_notification': next_id}
+
+def chore_page(chores, next_id):
+    """A page of assigned chores with the id to request the next page after
+    Args: (chores, next_id)"""
+
+    return {'chores': [chore_data(chore) for chore in chores], 'next_chore': next_id}
+
+def child_home_data():
+    """Data shown on the child home page"""
+
+    # Reloads the child if their cached points are out of date
+    family_version()
+    child = current_user
+    data = {'id': child.id, 'first_name': child.first_name, 'points': child.points}
+    data.update(chore_page(*load_chore_pages([child.id])[child.id]))
+    data.update(notification_page(ChildNotification, child.id))
+    return data
+
+def child_rewards_data():
+    """Data shown on the child rewards page"""
+
+    family_version()
+    rewards = Reward.query.filter_by(parent_id=current_user.parent_id).order_by(Reward.name)
+    return {'points': current_user.points,
+        'rewards': [{'id': reward.id, 'name': reward.name, 'cost': reward.cost}
+            for reward in rewards]}
+
+def parent_home_data():
+    """Data shown on the parent home page"""
+
+    family_version()
+    child_data, notifications, next_notification = load_dashboard(current_user.id)
+    return {'children': [{'username': child.username, 'first_name': child.first_name,
+            'points': child.points, 'chores': child.chores} for child in child_data],
+        'notifications': [notification_data(notification)
+            for notification in notifications],
+        'next_notification': next_notification}
+
+def parent_children_data():
+    """Data shown on the parent children page"""
+
+    family_version()
+    children = current_user.children.order_by(Child.id).all()
+    chore_pages = load_chore_pages([child.id for child in children])
+    child_data = []
+    for child in children:
+        child_dict = {'id': child.id, 'username': child.username,
+            'first_name': child.first_name, 'points': child.points}
+        child_dict.update(chore_page(*chore_pages[child.id]))
+        child_data.append(child_dict)
+    return {'children': child_data}
+
+@api_bp.route('/csrf')
+def csrf_token():
+    """CSRF token to send in the X-CSRFToken header of API mutations"""
+
+    return jsonify({'csrf_token': generate_csrf()})
+
+@api_bp.route('/child/home')
+@role_required('child')
+def child_home():
+    return resource(child_home_data())
+
+@api_bp.route('/child/notifications')
+@role_required('child')
+def child_notifications():
+    """Notifications after the ?after= notification id"""
+
+    return resource(notification_page(ChildNotification, current_user.id,
+        request.args.get('after', type=int)))
+
+@api_bp.route('/child/chores')
+@role_required('child')
+def child_chores():
+    """Assigned chores after the ?after= assigned chore id"""
+
+    chores, next_chore = load_chore_pages([current_user.id],
+        request.args.get('after', type=int))[current_user.id]
+    return resource(chore_page(chores, next_chore))
+
+@api_bp.route('/child/rewards')
+@role_required('child')
+def child_rewards():
+    return resource(child_rewards_data())
+
+@api_bp.route('/child/chores/<int:chore_id>/complete', methods=['POST'])
+@role_required('child')
+def child_complete_chore(chore_id):
+    if complete_chore(chore_id, current_user) is None:
+        return api_error(404, 'Chore not found')
+    return jsonify(child_home_data())
+
+@api_bp.route('/child/notifications/<int:notification_id>', methods=['DELETE'])
+@role_required('child')
+def child_acknowledge(notification_id):
+    if not acknowledge_notification(notification_id, current_user):
+        return api_error(404, 'Notification not found')
+    return jsonify(child_home_data())
+
+@api_bp.route('/child/rewards/<int:reward_id>/purchase', methods=['POST'])
+@role_required('child')
+def child_purchase(reward_id):
+    try:
+        purchased = purchase_reward(current_user, reward_id)
+    except RewardNotFound:
+        return api_error(404, 'Reward not found')
+    if purchased is None:
+        return api_error(409, 'You do not have enough points for this reward')
+    return jsonify(child_rewards_data())
+
+@api_bp.route('/parent/home')
+@role_required('parent')
+def parent_home():
+    return resource(parent_home_data())
+
+@api_bp.route('/parent/children')
+@role_required('parent')
+def parent_children():
+    return resource(parent_children_data())
+
+@api_bp.route('/parent/notifications')
+@role_required('parent')
+def parent_notifications():
+    """Notifications after the ?after= notification id"""
+
+    return resource(notification_page(ParentNotification, current_user.id,
+        request.args.get('after', type=int)))
+
+@api_bp.route('/parent/children/<int:child_id>/chores')
+@role_required('parent')
+def parent_child_chores(child_id):
+    """A child's assigned chores after the ?after= assigned chore id"""
+
+    child = Child.query.filter_by(id=child_id, parent_id=current_user.id).first()
+    if child is None:
+        return api_error(404, 'Child not found')
+    after = request.args.get('after', type=int)
+    return resource(chore_page(*load_chore_pages([child.id], after)[child.id]))
+
+@api_bp.route('/parent/chores/<int:chore_id>/approve', methods=['POST'])
+@role_required('parent')
+def parent_approve(chore_id):
+    if approve_chore(chore_id, current_user.id) is None:
+        return api_error(404, 'Chore not found')
+    return jsonify(parent_children_data())
+
+@api_bp.route('/parent/chores/<int:chore_id>/reject', methods=['POST'])
+@role_required('parent')
+def parent_reject(chore_id):
+    if reject_chore(chore_id, current_user.id) is None:
+        return api_error(404, 'Chore not found')
+    return jsonify(parent_children_data())
+
+@api_bp.route('/parent/chores/<int:chore_id>', methods=['DELETE'])
+@role_required('parent')
+def parent_delete_chore(chore_id):
+    if remove_assigned_chore(chore_id, current_user.id) is None:
+        return api_error(404, 'Chore not found')
+    return jsonify(parent_children_data())
+
+@api_bp.route('/parent/notifications/<int:notification_id>/deliver', methods=['POST'])
+@role_required('parent')
+def parent_deliver(notification_id):
+    if deliver_reward(notification_id, current_user.id) is None:
+        return api_error(404, 'Notification not found')
+    return jsonify(parent_home_data())
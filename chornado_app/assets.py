@@ -0,0 +1,156 @@
+import gzip
+import json
+import mimetypes
+import shutil
+from hashlib import sha256
+from os import makedirs, path, walk
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import with_appcontext
+
+# Folder under static holding fingerprinted files and the manifest
+BUILD_FOLDER = 'dist'
+MANIFEST = 'manifest.json'
+
+# Fingerprinted names change with their contents, so browsers may keep
+# them for a year without revalidating
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+# Files worth compressing. Images are already compressed
+COMPRESSIBLE = ('.css', '.js', '.ico', '.svg', '.json', '.txt')
+
+# Encodings in order of preference, with their file suffixes
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+def fingerprint(name, data):
+    """Static file name with a hash of its contents before the extension
+    Args: (name, data)"""
+
+    stem, extension = path.splitext(name)
+    return f'{stem}.{sha256(data).hexdigest()[:12]}{extension}'
+
+def compressors():
+    """Compression functions by encoding. brotli is only needed by
+    build-assets, so .br files are skipped if it isn't installed"""
+
+    available = {'gzip': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+    except ImportError:
+        click.echo('brotli is not installed, only writing .gz files')
+    else:
+        available['br'] = lambda data: brotli.compress(data, quality=11)
+    return available
+
+def static_files(static_folder):
+    """Yield names of source files in the static folder, relative to it,
+    skipping earlier builds
+    Args: (static_folder)"""
+
+    for directory, folders, files in walk(static_folder):
+        if directory == static_folder and BUILD_FOLDER in folders:
+            folders.remove(BUILD_FOLDER)
+        for file in sorted(files):
+            yield path.relpath(path.join(directory, file), static_folder) \
+                .replace(path.sep, '/')
+
+def build_assets(static_folder):
+    """Copy every static file into the build folder under a fingerprinted
+    name, with gzip and brotli variants where they are smaller, and write
+    the manifest mapping source names to them
+    Args: (static_folder)
+    Returns: manifest"""
+
+    build_folder = path.join(static_folder, BUILD_FOLDER)
+    shutil.rmtree(build_folder, ignore_errors=True)
+    compress = compressors()
+
+    manifest = {}
+    for name in static_files(static_folder):
+        with open(path.join(static_folder, name), 'rb') as file:
+            data = file.read()
+        built = f'{BUILD_FOLDER}/{fingerprint(name, data)}'
+        target = path.join(static_folder, built)
+        makedirs(path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as file:
+            file.write(data)
+
+        encodings = []
+        if name.endswith(COMPRESSIBLE):
+            for encoding, suffix in ENCODINGS:
+                if encoding not in compress:
+                    continue
+                compressed = compress[encoding](data)
+                if len(compressed) < len(data):
+                    with open(target + suffix, 'wb') as file:
+                        file.write(compressed)
+                    encodings.append(encoding)
+        manifest[name] = {'path': built, 'encodings': encodings}
+
+    with open(path.join(build_folder, MANIFEST), 'w') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+def load_manifest(static_folder):
+    """Manifest of the last build, or an empty one if there hasn't been one
+    Args: (static_folder)"""
+
+    try:
+        with open(path.join(static_folder, BUILD_FOLDER, MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def static_view(filename):
+    """Serve a fingerprinted file as immutable, precompressed for the
+    browser's Accept-Encoding when possible. Other static files are served
+    as before"""
+
+    encodings = current_app.extensions['assets'].get(filename)
+    if encodings is None:
+        return current_app.send_static_file(filename)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in ENCODINGS:
+        if encoding in encodings and request.accept_encodings[encoding]:
+            break
+    else:
+        encoding, suffix = None, ''
+    response = send_from_directory(current_app.static_folder, filename + suffix,
+        mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if encodings:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.immutable = True
+    return response
+
+def init_assets(app):
+    """Point url_for('static') at fingerprinted files from the last
+    build-assets run, and serve them with the static view above. Without a
+    build, static files are served unchanged
+    Args: (app)"""
+
+    manifest = load_manifest(app.static_folder)
+    if not manifest and not (app.debug or app.testing):
+        app.logger.warning('No static asset manifest, serving static files without '
+            'fingerprints or compression. Run build-assets when building the image')
+    # Encodings available for each fingerprinted path
+    app.extensions['assets'] = {entry['path']: entry['encodings']
+        for entry in manifest.values()}
+    app.view_functions['static'] = static_view
+
+    @app.url_defaults
+    def fingerprinted_static(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values['filename'] = manifest[values['filename']]['path']
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    """Fingerprint and precompress static files. Run at build time"""
+
+    manifest = build_assets(current_app.static_folder)
+    for name, entry in manifest.items():
+        encodings = ', '.join(entry['encodings']) or 'uncompressed'
+        click.echo(f'{name} -> {entry["path"]} ({encodings})')
@@ -1,10 +1,10 @@
 from flask import redirect, render_template, request, url_for, Blueprint, flash
 from flask_login import login_required, login_user, logout_user, LoginManager
-from werkzeug.security import check_password_hash
 
 from .forms import (LoginForm, ParentRegForm)
-from .sql_models import (Parent, Child)
-from .helpers import (register_parent, db_commit, flash_errors)
+from .passwords import (hash_password, verify_password, needs_rehash)
+from .helpers import (register_parent, db_commit, flash_errors,
+    load_cached_user, find_user)
 
 login_manager = LoginManager()
 auth_bp = Blueprint('auth', __name__)
@@ -13,11 +13,7 @@ auth_bp = Blueprint('auth', __name__)
 def load_user(username):
     '''Loads current user into session'''
 
-    user =  Parent.query.filter_by(username=username).first()
-    if user is not None and user.type == 'parent':
-        return user
-    user = Child.query.filter_by(username=username).first()
-    return user
+    return load_cached_user(username)
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -28,11 +24,13 @@ def login():
     if request.method == 'POST':
         password = form.password.data
         username = form.username.data
-        user = Parent.query.filter_by(username=username).first()
-        if user is None:
-            user = Child.query.filter_by(username=username).first()
+        user = find_user(username)
 
-        if user is not None and check_password_hash(user.password_hash, password):
+        if user is not None and verify_password(user.password_hash, password):
+            # Upgrade hashes made with an older method or work factor
+            if needs_rehash(user.password_hash):
+                user.password_hash = hash_password(password)
+                db_commit()
             login_user(user)
             return redirect(url_for('routes.index'))
 
@@ -62,9 +60,12 @@ def register():
         first_name = form.first_name.data
         last_name = form.last_name.data
         register_parent(username, password, first_name, last_name)
-        db_commit()
-        flash('Account created. Please login.', 'success')
-        return redirect(url_for('auth.login'))
+        # Fails if username was taken by a concurrent registration
+        if db_commit():
+            flash('Account created. Please login.', 'success')
+            return redirect(url_for('auth.login'))
+        flash('Username already exists', 'error')
+        return redirect(url_for('auth.register'))
 
     flash_errors(form)
     return render_template('register.html', template_form=form)
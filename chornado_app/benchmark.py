@@ -0,0 +1,281 @@
+import json
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from math import ceil
+from os import makedirs, path
+from random import Random
+from threading import Lock
+from time import perf_counter
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.engine import make_url
+
+from .passwords import hash_password
+from .helpers import remove_family
+from .query_stats import init_query_stats
+from .sql_models import (db, Account, Parent, Child, Chore, AssignedChore, Reward,
+    ParentNotification, ChildNotification, PointsEntry)
+
+# Password of every benchmark user
+PASSWORD = 'benchmark-password'
+
+# Usernames and ids of one seeded family
+BenchFamily = namedtuple('BenchFamily', ['parent', 'children', 'chores', 'assigned',
+    'reward_id'])
+
+class Recorder:
+    """Latency and query count of every request, grouped by route label"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = Lock()
+
+    def add(self, label, seconds, queries):
+        with self._lock:
+            self.samples[label].append((seconds, queries))
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers
+    Args: (values, pct)"""
+
+    ordered = sorted(values)
+    return ordered[max(ceil(pct / 100 * len(ordered)) - 1, 0)]
+
+def remove_families(prefix):
+    """Delete parents whose username starts with prefix, with their families
+    Args: (prefix)"""
+
+    parent_ids = db.session.execute(db.select(Parent.id)
+        .where(Parent.username.startswith(f'{prefix}-'))).scalars().all()
+    remove_family(parent_ids)
+    db.session.commit()
+    return len(parent_ids)
+
+def seed_families(prefix, families, children, chores, notifications, rng):
+    """Add benchmark families. Every child has each of the family's chores
+    assigned, and the parent and each child get notifications.
+    Args: (prefix, families, children, chores, notifications, rng)
+    Returns: list of BenchFamily"""
+
+    pw_hash = hash_password(PASSWORD)
+    seeded = []
+    for family in range(families):
+        parent = Parent(username=f'{prefix}-{family}@example.com', first_name='Bench',
+            last_name=f'Family {family}', password_hash=pw_hash)
+        db.session.add(parent)
+        db.session.add(Account(username=parent.username, type='parent', parent=parent))
+        kids = []
+        for number in range(children):
+            child = Child(username=f'{prefix}-{family}-{number}',
+                first_name=f'Child {number}', password_hash=pw_hash, parent=parent,
+                points=rng.randint(0, 50))
+            db.session.add(child)
+            db.session.add(Account(username=child.username, type='child', child=child))
+            kids.append(child)
+        family_chores = [Chore(name=f'Chore {number}', value=rng.randint(1, 10),
+            parent=parent) for number in range(chores)]
+        reward = Reward(name='Benchmark reward', cost=1, parent=parent)
+        db.session.add_all(family_chores + [reward])
+        db.session.flush()
+        # Starting points are recorded in the ledger, as migration 4 does
+        # for existing children, so reconcile-points agrees with them
+        db.session.add_all([PointsEntry(child_id=child.id, delta=child.points,
+            balance=child.points, reason='Opening balance')
+            for child in kids if child.points])
+
+        assigned = {}
+        for child in kids:
+            rows = [AssignedChore(state='Active', chore_id=chore.id, user_id=child.id)
+                for chore in family_chores]
+            db.session.add_all(rows)
+            db.session.flush()
+            assigned[child.username] = [row.id for row in rows]
+            # Reward notifications, as there can only be one chore
+            # notification of each type per assigned chore
+            for number in range(notifications):
+                db.session.add(ParentNotification(type='reward',
+                    message=f'{child.first_name} has purchased Benchmark reward',
+                    parent_id=parent.id, child_id=child.id, reward_id=reward.id))
+                db.session.add(ChildNotification(type='reward',
+                    message='You have been given Benchmark reward!',
+                    child_id=child.id, reward_id=reward.id))
+        db.session.commit()
+        seeded.append(BenchFamily(parent.username, [child.username for child in kids],
+            [(chore.id, chore.name, chore.value) for chore in family_chores],
+            assigned, reward.id))
+    return seeded
+
+class Session:
+    """Logged in test client that records each request it makes"""
+
+    def __init__(self, app, recorder):
+        self.client = app.test_client()
+        self.recorder = recorder
+        self.csrf_token = None
+
+    def request(self, label, method, url, data=None, headers=None):
+        headers = {'Referer': url, **(headers or {})}
+        if data is not None:
+            data = {'csrf_token': self.csrf_token, **data}
+        start = perf_counter()
+        response = self.client.open(url, method=method, data=data, headers=headers)
+        elapsed = perf_counter() - start
+        queries = response.headers.get('X-Query-Count')
+        self.recorder.add(label, elapsed, int(queries) if queries is not None else None)
+        if response.status_code >= 400:
+            raise click.ClickException(f'{label}: {method} {url} returned '
+                f'{response.status_code}')
+        return response
+
+    def login(self, username):
+        self.csrf_token = self.client.get('/api/v1/csrf').json['csrf_token']
+        response = self.request('POST auth.login', 'POST', '/login',
+            {'username': username, 'password': PASSWORD, 'submit': 'Login'})
+        if response.location.endswith('/login'):
+            raise click.ClickException(f'Login failed for {username}')
+
+def run_family(app, family, rounds, recorder):
+    """Drive a parent and their children through the site
+    Args: (app, family, rounds, recorder)"""
+
+    parent = Session(app, recorder)
+    parent.login(family.parent)
+    children = []
+    for username in family.children:
+        child = Session(app, recorder)
+        child.login(username)
+        children.append((username, child))
+
+    for number in range(rounds):
+        response = parent.request('GET parent.home', 'GET', '/parent/home')
+        parent.request('GET parent.home (revalidate)', 'GET', '/parent/home',
+            headers={'If-None-Match': response.headers['ETag']})
+        parent.request('GET parent.children', 'GET', '/parent/children')
+        parent.request('GET parent.chores', 'GET', '/parent/chores')
+        parent.request('GET parent.rewards', 'GET', '/parent/rewards')
+
+        for username, child in children:
+            child.request('GET child.home', 'GET', '/child/home')
+            child.request('GET child.rewards', 'GET', '/child/rewards')
+            assigned_id = family.assigned[username][number]
+            child.request('POST child.home (complete)', 'POST', '/child/home',
+                {'chore_id': assigned_id, 'complete': 'Complete'})
+            parent.request('POST parent.children (approve)', 'POST', '/parent/children',
+                {'chore_id': assigned_id, 'approve': 'Approve'})
+            child.request('POST child.rewards (purchase)', 'POST', '/child/rewards',
+                {'reward_id': family.reward_id, 'cost': 1, 'name': 'Benchmark reward',
+                    'purchase': 'Purchase'})
+
+        chore_id, name, value = family.chores[number % len(family.chores)]
+        parent.request('POST parent.chores (create)', 'POST', '/parent/chores',
+            {'name': f'{name} extra', 'value': value, 'create': 'Create'})
+
+def summarize(recorder, elapsed):
+    """Per route count, latency percentiles in ms and mean queries
+    Args: (recorder, elapsed)
+    Returns: dict of route label to stats"""
+
+    routes = {}
+    for label, samples in sorted(recorder.samples.items()):
+        times = [seconds * 1000 for seconds, _ in samples]
+        queries = [count for _, count in samples if count is not None]
+        routes[label] = {'count': len(samples),
+            'p50_ms': round(percentile(times, 50), 2),
+            'p95_ms': round(percentile(times, 95), 2),
+            'p99_ms': round(percentile(times, 99), 2),
+            'queries': round(sum(queries) / len(queries), 1) if queries else None,
+            'per_second': round(len(samples) / elapsed, 1)}
+    return routes
+
+def print_results(results, previous=None):
+    """Print results table, with the p95 change from previous results
+    Args: (results, previous)"""
+
+    click.echo(f'{"route":<32}{"count":>7}{"p50 ms":>9}{"p95 ms":>9}{"p99 ms":>9}'
+        f'{"queries":>9}{"req/s":>8}' + (f'{"p95 diff":>10}' if previous else ''))
+    for label, stats in results['routes'].items():
+        line = (f'{label:<32}{stats["count"]:>7}{stats["p50_ms"]:>9}{stats["p95_ms"]:>9}'
+            f'{stats["p99_ms"]:>9}{str(stats["queries"]):>9}{stats["per_second"]:>8}')
+        before = previous['routes'].get(label) if previous else None
+        if before:
+            change = (stats['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+            line += f'{change:>+9.0f}%'
+        click.echo(line)
+    click.echo(f'{results["requests"]} requests in {results["seconds"]} s, '
+        f'{results["per_second"]} requests/s')
+
+def is_local_database(uri):
+    """Returns true for SQLite and databases on this machine
+    Args: (uri)"""
+
+    url = make_url(uri)
+    return url.get_backend_name() == 'sqlite' or url.host in ('localhost', '127.0.0.1')
+
+@click.command('benchmark')
+@click.option('--families', default=10, help='Families to seed.')
+@click.option('--children', default=3, help='Children per family.')
+@click.option('--chores', default=10, help='Chores per family, assigned to every child.')
+@click.option('--notifications', default=5, help='Notifications per child.')
+@click.option('--rounds', default=5, help='Passes through the site per family.')
+@click.option('--concurrency', default=1, help='Families driven at the same time.')
+@click.option('--seed', 'random_seed', default=1, help='Random seed for seeded data.')
+@click.option('--prefix', default='bench', help='Username prefix of benchmark users.')
+@click.option('--output', type=click.Path(), help='JSON results file. Defaults to '
+    'instance/benchmarks/<time>.json.')
+@click.option('--compare', type=click.File(), help='Earlier results file to compare with.')
+@click.option('--keep', is_flag=True, help='Keep benchmark families afterwards.')
+@click.option('--allow-remote', is_flag=True, help='Run against a non-local database.')
+@with_appcontext
+def benchmark_command(families, children, chores, notifications, rounds, concurrency,
+    random_seed, prefix, output, compare, keep, allow_remote):
+    """Seed families and time scripted parent and child sessions"""
+
+    app = current_app._get_current_object()
+    if not allow_remote and not is_local_database(app.config['SQLALCHEMY_DATABASE_URI']):
+        raise click.ClickException('Refusing to seed a remote database, '
+            'use --allow-remote to override')
+    if rounds > chores:
+        raise click.ClickException('--rounds can be at most --chores')
+    if not app.config['QUERY_STATS']:
+        init_query_stats(app)
+    # Throttling logins would measure the queue rather than the app
+    app.config['PASSWORD_HASH_QUEUE'] = max(app.config['PASSWORD_HASH_QUEUE'],
+        concurrency * (children + 1))
+
+    remove_families(prefix)
+    seeded = seed_families(prefix, families, children, chores, notifications,
+        Random(random_seed))
+    click.echo(f'Seeded {families} families')
+
+    recorder = Recorder()
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for result in [executor.submit(run_family, app, family, rounds, recorder)
+                for family in seeded]:
+            result.result()
+    elapsed = perf_counter() - start
+    db.session.remove()
+
+    request_count = sum(len(samples) for samples in recorder.samples.values())
+    results = {'time': datetime.now().isoformat(timespec='seconds'),
+        'options': {'families': families, 'children': children, 'chores': chores,
+            'notifications': notifications, 'rounds': rounds, 'concurrency': concurrency,
+            'seed': random_seed, 'database': make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+                .get_backend_name()},
+        'requests': request_count, 'seconds': round(elapsed, 2),
+        'per_second': round(request_count / elapsed, 1),
+        'routes': summarize(recorder, elapsed)}
+    print_results(results, json.load(compare) if compare else None)
+
+    if output is None:
+        makedirs(path.join(app.instance_path, 'benchmarks'), exist_ok=True)
+        output = path.join(app.instance_path, 'benchmarks',
+            f'{datetime.now():%Y%m%d-%H%M%S}.json')
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    click.echo(f'Results saved to {output}')
+
+    if not keep:
+        remove_families(prefix)
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from werkzeug.utils import import_string
+
+class LocalCache:
+    """Process-local LRU cache with a per-entry time to live.
+    Backends shared between workers must provide the same get, set,
+    delete and clear methods and store picklable values."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return cached value, or None if missing or expired"""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store value, evicting the least recently used entry if full"""
+
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Remove value from cache"""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove all values from cache"""
+
+        with self._lock:
+            self._entries.clear()
+
+def make_cache(app, prefix):
+    """Create the cache configured by {prefix}_BACKEND, {prefix}_SIZE and
+    {prefix}_TTL. The backend is a LocalCache unless an import path to a
+    shared backend class is configured.
+    Args: (app, prefix)"""
+
+    backend = app.config.get(f'{prefix}_BACKEND') or LocalCache
+    if isinstance(backend, str):
+        backend = import_string(backend)
+    return backend(maxsize=app.config.get(f'{prefix}_SIZE', 1024),
+        ttl=app.config.get(f'{prefix}_TTL', 300))
@@ -1,16 +1,18 @@
-from flask import redirect, render_template, request, Blueprint, flash
+from flask import redirect, render_template, request, Blueprint, flash, url_for
 from flask_login import login_required, current_user
 
 from .forms import (NotificationForm, AssignedChoreForm, RewardForm)
-from .sql_models import (db, Parent, AssignedChore, ChildNotification, Chore,
-    Reward)
-from .helpers import (db_commit, redirect_url, complete_chore, flash_errors,
-    request_reward)
+from .sql_models import (Parent, ChildNotification)
+from .services import (complete_chore, purchase_reward, acknowledge_notification,
+    RewardNotFound)
+from .helpers import (redirect_url, flash_errors, load_notifications, load_chore_pages,
+    family_etag, fragment)
 
 child_bp = Blueprint('child', __name__, url_prefix="/child")
 
 @child_bp.route("/home", methods=['Get', 'Post'])
 @login_required
+@family_etag
 def home():
     """Children home page"""
 
@@ -20,44 +22,67 @@ def home():
     if request.method == 'POST':
         if notification_form.validate() and notification_form.acknowledge.data:
             notification_id = notification_form.notification_id.data
-            notification = ChildNotification.query.get(notification_id)
-            db.session.delete(notification)
-            db_commit()
+            acknowledge_notification(notification_id, current_user)
 
         elif chore_form.validate() and chore_form.complete.data:
             chore_id = chore_form.chore_id.data
-            complete_chore(chore_id)
+            complete_chore(chore_id, current_user)
         return redirect(redirect_url())
 
     child = current_user
-    notifications = child.notifications
-    chores = []
-    assigned_chores = child.assigned_chores.order_by(AssignedChore.id)
-    for assigned_chore in assigned_chores:
-        chore_info = Chore.query.get(assigned_chore.chore_id)
-        chore_dict = {'id': assigned_chore.id, 'name': chore_info.name,
-            'points': chore_info.value, 'state': assigned_chore.state}
-
-        chores.append(chore_dict)
+    notifications, next_notification = load_notifications(ChildNotification, child.id)
+    chores, next_chore = load_chore_pages([child.id])[child.id]
 
     return render_template("children/home.html", child=child, chores=chores,
-        notifications=notifications, notification_form=notification_form,
+        next_chore=next_chore, notifications=notifications,
+        next_notification=next_notification, notification_form=notification_form,
         chore_form=chore_form)
 
+@child_bp.route("/notifications")
+@login_required
+def more_notifications():
+    """Notifications after the ?after= notification id, as list items for
+    the home page's load more button"""
+
+    if current_user.type != 'child':
+        return redirect(url_for('routes.index'))
+
+    notifications, next_notification = load_notifications(ChildNotification,
+        current_user.id, request.args.get('after', type=int))
+    next_url = next_notification and url_for('child.more_notifications',
+        after=next_notification)
+    return fragment(render_template("children/_notification_items.html",
+        notifications=notifications, notification_form=NotificationForm()), next_url)
+
+@child_bp.route("/chores")
+@login_required
+def more_chores():
+    """Assigned chores after the ?after= assigned chore id, as table rows
+    for the home page's load more button"""
+
+    if current_user.type != 'child':
+        return redirect(url_for('routes.index'))
+
+    chores, next_chore = load_chore_pages([current_user.id],
+        request.args.get('after', type=int))[current_user.id]
+    next_url = next_chore and url_for('child.more_chores', after=next_chore)
+    return fragment(render_template("children/_chore_rows.html", chores=chores,
+        chore_form=AssignedChoreForm()), next_url)
+
 @child_bp.route("/rewards", methods=["GET", "POST"])
 @login_required
+@family_etag
 def rewards():
     """Children rewards page"""
 
     form =  RewardForm()
 
     if request.method == 'POST' and form.validate_on_submit():
-        reward = Reward.query.get(form.reward_id.data)
-        if reward.cost > current_user.points:
-            flash('You do not have enough points for this reward', 'error')
-            return redirect(redirect_url())
-
-        request_reward(current_user, reward)
+        try:
+            if purchase_reward(current_user, form.reward_id.data) is None:
+                flash('You do not have enough points for this reward', 'error')
+        except RewardNotFound:
+            flash('That reward is no longer available', 'error')
         return redirect(redirect_url())
 
     rewards = Parent.query.get(current_user.parent_id).rewards
@@ -0,0 +1,156 @@
+import json
+import select
+from collections import defaultdict
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from time import sleep
+from flask import current_app
+from sqlalchemy import create_engine, exc, text
+from sqlalchemy.pool import NullPool
+
+# PostgreSQL channel carrying events for every user
+PG_CHANNEL = 'chornado_events'
+
+class Subscription:
+    """Queue of events published to one channel"""
+
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = Queue(maxsize=100)
+
+    def get(self, timeout):
+        """Return next event, or None if none arrives within timeout"""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+class LocalBroker:
+    """In-process publish/subscribe. Events only reach subscribers in the
+    same worker process, so this is used for tests and single workers"""
+
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._lock = Lock()
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel)
+        with self._lock:
+            self._subscribers[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.channel]
+
+    def publish(self, channel, event):
+        self.dispatch(channel, event)
+
+    def dispatch(self, channel, event):
+        """Pass event to this process's subscribers. Events for a
+        subscriber that has stopped reading are dropped"""
+
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(event)
+            except Full:
+                pass
+
+class PostgresBroker(LocalBroker):
+    """Publish/subscribe across workers and machines using LISTEN/NOTIFY.
+    Each process holds one listening connection, outside the pool, and
+    passes events on to its local subscribers"""
+
+    def __init__(self, engine, logger):
+        super().__init__()
+        self.engine = engine
+        self.logger = logger
+        self._listener = None
+
+    def subscribe(self, channel):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = Thread(target=self._listen, daemon=True)
+                self._listener.start()
+        return super().subscribe(channel)
+
+    def publish(self, channel, event):
+        payload = json.dumps({'channel': channel, 'event': event})
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(text('SELECT pg_notify(:pg_channel, :payload)'),
+                    {'pg_channel': PG_CHANNEL, 'payload': payload})
+                connection.commit()
+        except exc.SQLAlchemyError as error:
+            # Pages still show the notification on their next load
+            self.logger.warning('Event publish failed: %s', error)
+
+    def _listen(self):
+        """Receive notifications until the process exits, reconnecting
+        after errors"""
+
+        while True:
+            connection = None
+            try:
+                connection = self.engine.raw_connection()
+                connection.detach()
+                dbapi_connection = connection.dbapi_connection
+                dbapi_connection.autocommit = True
+                dbapi_connection.cursor().execute(f'LISTEN {PG_CHANNEL}')
+                while True:
+                    if select.select([dbapi_connection], [], [], 30) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        data = json.loads(notify.payload)
+                        self.dispatch(data['channel'], data['event'])
+            except Exception as error:
+                self.logger.warning('Event listener error: %s', error)
+                sleep(5)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+def user_channel(user_type, user_id):
+    """Channel name for a parent or child user
+    Args: (user_type, user_id)"""
+
+    return f'{user_type}:{user_id}'
+
+def publish_notification(user_type, user_id, message):
+    """Send a new notification message to a user's open pages
+    Args: (user_type, user_id, message)"""
+
+    event = {'type': 'notification', 'message': message}
+    current_app.extensions['events'].publish(user_channel(user_type, user_id), event)
+
+def init_events(app):
+    """Create the event broker set by EVENTS_BACKEND, local or postgres.
+    The postgres broker connects to EVENTS_DATABASE_URI if set
+    Args: (app)"""
+
+    if app.config['EVENTS_BACKEND'] == 'postgres':
+        # LISTEN needs a session of its own, which PgBouncer in transaction
+        # mode can't provide, so the listener may use a direct connection
+        if app.config.get('EVENTS_DATABASE_URI'):
+            engine = create_engine(app.config['EVENTS_DATABASE_URI'], poolclass=NullPool)
+        else:
+            from .sql_models import db
+            with app.app_context():
+                engine = db.engine
+        broker = PostgresBroker(engine, app.logger)
+    else:
+        broker = LocalBroker()
+    app.extensions['events'] = broker
@@ -1,10 +1,12 @@
 from flask_login import current_user
 from flask_wtf import FlaskForm
 from wtforms import (StringField, SubmitField, PasswordField, IntegerField,
-    SelectField, HiddenField)
+    SelectField, SelectMultipleField, HiddenField)
 from wtforms.validators import (InputRequired, EqualTo, Length, ValidationError,
     NumberRange, Email)
-from .sql_models import (Parent, Child, AssignedChore)
+from .sql_models import (Child, AssignedChore)
+from .helpers import username_taken
+from .scheduler import WEEKDAYS
 
 class LoginForm(FlaskForm):
     """Form for logging in users"""
@@ -28,9 +30,7 @@ class ParentRegForm(FlaskForm):
     def validate_username(self, field):
         '''Custom validator to check that username is unique'''
 
-        parent_user = Parent.query.filter_by(username=field.data).first()
-        child_user = Child.query.filter_by(username=field.data).first()
-        if parent_user is not None or child_user is not None:
+        if username_taken(field.data):
             raise ValidationError("Username already exists")
         
 
@@ -61,9 +61,7 @@ class ChildRegForm(FlaskForm):
     def validate_username(self, field):
         '''Custom validator to check that username is unique'''
 
-        parent_user = Parent.query.filter_by(username=field.data).first()
-        child_user = Child.query.filter_by(username=field.data).first()
-        if parent_user is not None or child_user is not None:
+        if username_taken(field.data):
             raise ValidationError("Username already exists")
 
     first_name = StringField('First name',
@@ -112,6 +110,32 @@ class ChoreForm(FlaskForm):
             if chore is not None:
                 raise ValidationError("This chore has already been assigned to this child.")
 
+class BulkAssignForm(FlaskForm):
+    """Form for assigning many chores to many children at once.
+    Choices are set by the route from the parent's chores and children"""
+
+    chores = SelectMultipleField('Chores', coerce=int,
+        validators=[InputRequired("Please select at least one chore")])
+    children = SelectMultipleField('Children', coerce=int,
+        validators=[InputRequired("Please select at least one child")])
+    bulk_assign = SubmitField('Assign selected')
+
+class ScheduleForm(FlaskForm):
+    """Form for assigning a chore to a child on a recurring schedule.
+    Choices are set by the route from the parent's chores and children"""
+
+    schedule_chore = SelectField('Chore', coerce=int)
+    schedule_child = SelectField('Child', coerce=int)
+    days = SelectMultipleField('Days', coerce=int, choices=list(enumerate(WEEKDAYS)),
+        validators=[InputRequired("Please select at least one day")])
+    schedule = SubmitField('Schedule')
+
+class RemoveScheduleForm(FlaskForm):
+    """Form for removing recurring chore schedules"""
+
+    schedule_id = HiddenField('Schedule ID')
+    unschedule = SubmitField('Remove')
+
 class AssignedChoreForm(FlaskForm):
     """Form for approving, rejecting, completing and deleting assigned chores"""
 
@@ -0,0 +1,63 @@
+from flask import current_app, request
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from .cache import make_cache
+from .helpers import family_id, family_version
+
+# Stands in for the session's CSRF token inside stored fragments
+CSRF_PLACEHOLDER = '__chornado_csrf_token__'
+
+def fragment_key(name):
+    """Cache key for a fragment of the logged in user's family pages, or
+    None if the fragment should not be cached. Keys include the family data
+    version, so fragments are replaced as soon as the family changes.
+    Args: (name)"""
+
+    # Re-rendered forms after a failed POST show submitted values
+    if request.method != 'GET' or not current_user.is_authenticated:
+        return None
+    return (f'{name}:{family_id(current_user)}:{family_version()}:'
+        f'{current_app.config["ETAG_SALT"]}')
+
+class FragmentCacheExtension(Extension):
+    """Jinja tag caching the rendered HTML of a template block:
+
+        {% cache 'parent_chores' %} ... {% endcache %}
+
+    The session's CSRF token is swapped for a placeholder when a fragment
+    is stored and filled in again each time it is used."""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render_fragment', [name]),
+            [], [], body).set_lineno(lineno)
+
+    def _render_fragment(self, name, caller):
+        key = fragment_key(name)
+        if key is None:
+            return caller()
+
+        cache = current_app.extensions['fragment_cache']
+        fragment = cache.get(key)
+        csrf_token = generate_csrf()
+        if fragment is None:
+            fragment = str(caller()).replace(csrf_token, CSRF_PLACEHOLDER)
+            cache.set(key, fragment)
+        return Markup(fragment.replace(CSRF_PLACEHOLDER, csrf_token))
+
+def init_fragment_cache(app):
+    """Add the {% cache %} template tag, storing fragments in the cache
+    configured by FRAGMENT_CACHE_BACKEND, FRAGMENT_CACHE_SIZE and
+    FRAGMENT_CACHE_TTL
+    Args: (app)"""
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.extensions['fragment_cache'] = make_cache(app, 'FRAGMENT_CACHE')
@@ -1,10 +1,26 @@
-from flask import request, url_for, flash
+from collections import namedtuple
+from functools import wraps
+from hashlib import sha1
+from time import time
+from flask import (request, url_for, flash, current_app, g, session, make_response,
+    Response)
 from flask_login import current_user
-from werkzeug.security import generate_password_hash
-from sqlalchemy import exc
+from sqlalchemy import exc, func, inspect, literal, or_
+from sqlalchemy.orm import aliased, make_transient_to_detached
 
-from .sql_models import (db, Chore, AssignedChore, Parent, Child, Reward,
-    ParentNotification, ChildNotification)
+from .passwords import hash_password
+from .sql_models import (db, Account, Chore, AssignedChore, ChoreSchedule, Parent,
+    Child, Reward, ParentNotification, ChildNotification, PointsEntry, ActivityLog)
+
+# Row used by templates to display assigned chores
+ChoreRow = namedtuple('ChoreRow', ['id', 'name', 'points', 'state', 'user_id'])
+
+# Notifications and assigned chores shown per page and per "load more"
+NOTIFICATION_PAGE_SIZE = 20
+CHORE_PAGE_SIZE = 20
+
+# User models by their type column, for rebuilding cached users
+USER_MODELS = {'parent': Parent, 'child': Child}
 
 def redirect_url(default='home'):
     """Redirect back to referring page"""
@@ -12,11 +28,51 @@ def redirect_url(default='home'):
            request.referrer or \
            url_for(default)
 
+def touch_family(parent_id):
+    """Mark family as changed by a bulk statement that the session can't
+    track, so db_commit() increments its data version
+    Args: (parent_id)"""
+
+    db.session.info.setdefault('touched_families', set()).add(parent_id)
+
+def bump_family_versions():
+    """Increment data_version of every family with pending changes in the
+    session, in one UPDATE"""
+
+    changed = list(db.session.new) + list(db.session.deleted) + \
+        [obj for obj in db.session.dirty if db.session.is_modified(obj)]
+    parent_ids = db.session.info.pop('touched_families', set())
+    if not changed and not parent_ids:
+        return
+
+    # Flush so foreign keys set through relationships are populated
+    db.session.flush()
+    child_ids = set()
+    for obj in changed:
+        if isinstance(obj, Parent):
+            parent_ids.add(obj.id)
+        elif isinstance(obj, (AssignedChore, ChoreSchedule)):
+            child_ids.add(obj.user_id)
+        elif isinstance(obj, (ChildNotification, PointsEntry)):
+            child_ids.add(obj.child_id)
+        elif isinstance(obj, (Child, Chore, Reward, ParentNotification, ActivityLog)):
+            parent_ids.add(obj.parent_id)
+
+    families = Parent.id.in_(parent_ids)
+    if child_ids:
+        families = or_(families, Parent.id.in_(
+            db.select(Child.parent_id).where(Child.id.in_(child_ids))))
+    db.session.execute(db.update(Parent).where(families)
+        .values(data_version=Parent.data_version + 1)
+        .execution_options(synchronize_session=False))
+
 def db_commit():
-    """Attempt to commit changes to database.
+    """Attempt to commit changes to database, incrementing the data version
+    of every family that changed.
         Returns true if successful"""
 
     try:
+        bump_family_versions()
         db.session.commit()
         return True
     except exc.SQLAlchemyError as error:
@@ -24,23 +80,144 @@ def db_commit():
         db.session.rollback()
         return False
 
+def find_user_version(username):
+    """Resolve username to its parent or child user, and the data version
+    of their family, in one query
+    Args: (username)
+    Returns: (user, family_version), or (None, None)"""
+
+    family = aliased(Parent)
+    row = db.session.execute(
+        db.select(Parent, Child, family.data_version)
+        .select_from(Account)
+        .outerjoin(Parent, Parent.id == Account.parent_id)
+        .outerjoin(Child, Child.id == Account.child_id)
+        .outerjoin(family, family.id == func.coalesce(Account.parent_id, Child.parent_id))
+        .where(Account.username == username)).first()
+    if row is None:
+        return None, None
+    return row.Parent or row.Child, row.data_version
+
+def find_user(username):
+    """Resolve username to its parent or child user in one query
+    Args: (username)"""
+
+    return find_user_version(username)[0]
+
+def username_taken(username):
+    """Returns true if username belongs to any parent or child user
+    Args: (username)"""
+
+    return db.session.execute(db.select(Account.username)
+        .where(Account.username == username)).first() is not None
+
+def user_snapshot(user, version):
+    """Column values of a user for the user cache, with the family data
+    version they were read at. The password hash is left out and loaded
+    from the database only when it is needed.
+    Args: (user, version)"""
+
+    snapshot = {attr.key: getattr(user, attr.key)
+        for attr in inspect(type(user)).column_attrs
+        if attr.key not in ('password_hash', 'data_version')}
+    snapshot['family_version'] = version
+    return snapshot
+
+def load_cached_user(username):
+    """Load user by username, using the user cache to skip the database.
+    The user's snapshot_version is the family data version their values
+    were read at, checked by family_version()
+    Args: (username)"""
+
+    cache = current_app.extensions['user_cache']
+    snapshot = cache.get(username)
+
+    if snapshot is None:
+        user, version = find_user_version(username)
+        if user is not None:
+            cache.set(username, user_snapshot(user, version))
+            user.snapshot_version = version
+        return user
+
+    # Attach cached user to session without issuing a SELECT
+    values = dict(snapshot)
+    version = values.pop('family_version', None)
+    user = USER_MODELS[values['type']](**values)
+    make_transient_to_detached(user)
+    user = db.session.merge(user, load=False)
+    user.snapshot_version = version
+    return user
+
+def refresh_stale_user(version):
+    """Reload the logged in user if their cached values were read at an
+    older family data version, as another worker may have changed them
+    (a child's points, say) without this worker's cache knowing. The fresh
+    values are cached again
+    Args: (version)"""
+
+    user = current_user._get_current_object()
+    loaded = getattr(user, 'snapshot_version', None)
+    if loaded is not None and loaded >= version:
+        return
+    db.session.refresh(user)
+    user.snapshot_version = version
+    current_app.extensions['user_cache'].set(user.username, user_snapshot(user, version))
+
+def invalidate_user(*usernames):
+    """Remove users from the user cache after their account changes
+    Args: (*usernames)"""
+
+    cache = current_app.extensions['user_cache']
+    for username in usernames:
+        cache.delete(username)
+
 def register_parent(username, password, first_name, last_name):
     """Register new parent users
     Args: (username, password, first_name, last_name)"""
 
-    pw_hash = generate_password_hash(password, method='pbkdf2:sha256', salt_length=8)
+    pw_hash = hash_password(password)
     new_user = Parent(username=username, first_name=first_name, last_name=last_name,
         password_hash=pw_hash)
     db.session.add(new_user)
+    db.session.add(Account(username=username, type='parent', parent=new_user))
 
 def register_child(username, password, first_name):
     """Register new parent and child users
     Args: (username, password, first_name)"""
 
-    pw_hash = generate_password_hash(password, method='pbkdf2:sha256', salt_length=8)
+    pw_hash = hash_password(password)
     new_user = Child(username=username, first_name=first_name, password_hash=pw_hash,
         parent=current_user)
     db.session.add(new_user)
+    db.session.add(Account(username=username, type='child', child=new_user))
+
+def remove_child(child_id, parent_id):
+    """Delete parent's child with one DELETE. Their account, chores,
+    schedules, points and notifications go with it through ON DELETE CASCADE
+    Args: (child_id, parent_id)
+    Returns: (username, first_name) of deleted child, or None if not parent's child"""
+
+    deleted = db.session.execute(db.delete(Child)
+        .where(Child.id == child_id, Child.parent_id == parent_id)
+        .returning(Child.username, Child.first_name)
+        .execution_options(synchronize_session=False)).first()
+    if deleted is not None:
+        touch_family(parent_id)
+    return deleted
+
+def remove_family(parent_ids):
+    """Delete parents and everything in their families with one DELETE,
+    through ON DELETE CASCADE
+    Args: (parent_ids)
+    Returns: usernames of deleted parents and children"""
+
+    children = db.select(Child.id).where(Child.parent_id.in_(parent_ids))
+    usernames = db.session.execute(db.select(Account.username)
+        .where(or_(Account.parent_id.in_(parent_ids),
+            Account.child_id.in_(children)))).scalars().all()
+    db.session.execute(db.delete(Parent).where(Parent.id.in_(parent_ids))
+        .execution_options(synchronize_session=False))
+    return usernames
 
 def create_chore(name, value, parent_id):
     """Add new chore to database
@@ -57,6 +234,25 @@ def assign_chore(chore_id, user_id):
         user_id=user_id)
     db.session.add(new_assigned_chore)
 
+def bulk_assign_chores(chore_ids, child_ids, parent_id):
+    """Assign every chore to every child with a single INSERT ... SELECT.
+    Pairs already assigned, and chores or children outside the parent's
+    family, are skipped.
+    Args: (chore_ids, child_ids, parent_id)
+    Returns: number of chores assigned"""
+
+    already_assigned = db.select(AssignedChore.id).where(
+        AssignedChore.chore_id == Chore.id, AssignedChore.user_id == Child.id)
+    new_pairs = (db.select(literal('Active'), Chore.id, Child.id)
+        .join(Child, Child.parent_id == Chore.parent_id)
+        .where(Chore.parent_id == parent_id, Chore.id.in_(chore_ids),
+            Child.id.in_(child_ids), ~already_assigned.exists()))
+
+    result = db.session.execute(db.insert(AssignedChore)
+        .from_select(['state', 'chore_id', 'user_id'], new_pairs))
+    touch_family(parent_id)
+    return result.rowcount
+
 def edit_chore(chore, name, value):
     """Edit existing chore
     Args: (chore, name, value)"""
@@ -65,46 +261,6 @@ def edit_chore(chore, name, value):
     chore.value = value
     return chore
 
-def complete_chore(chore_id):
-    """Mark chore as completed and generate notification to parent
-    Args: (chore_id)"""
-
-    assigned_chore = AssignedChore.query.get(chore_id)
-    child = Child.query.get(assigned_chore.user_id)
-    chore = Chore.query.get(assigned_chore.chore_id)
-    assigned_chore.state = 'Complete'
-    message = f'{child.first_name} has completed {chore.name}.'
-    new_notification = ParentNotification(type='chore', message=message,
-        parent_id=child.parent_id, child_id=child.id, chore_id=chore_id)   
-
-    db.session.add(new_notification)
-    db_commit()
-
-def approve_completed(chore, child, new_points):
-    """Approve completed chore, and assign points to child
-    Args: (chore, child, new_points)"""
-
-    child.points += new_points
-    db.session.delete(chore)
-    return child
-
-def reject_completed(chore):
-    """Reject completed chore, and remove attached notifications
-    Args: (chore)"""
-
-    chore.state = 'Rejected'
-    notifications = chore.parent_notifications
-    for notification in notifications:
-        db.session.delete(notification)
-    chore_name = Chore.query.get(chore.chore.id).name
-    child_id = chore.user_id
-    message = f'Your parent says that {chore_name} needs another try.'
-    new_notification = ChildNotification(type='chore', message=message,
-        child_id=child_id, chore_id=chore.id)
-    db.session.add(new_notification)
-    db_commit()
-    return chore
-
 def create_reward(name, cost, parent_id):
     """Add new reward to database
     Args: (name, cost, parent_id)"""
@@ -120,17 +276,140 @@ def edit_reward(reward, name, cost):
     reward.cost = cost
     return reward
 
-def request_reward(user, reward):
-    """Request reward from list, deduct points, and send notification to parent
-    Args: (user, reward)"""
+def load_dashboard(parent_id):
+    """Load child summaries and notifications for the parent dashboard
+    in two queries, regardless of the number of children.
+    Args: (parent_id)
+    Returns: (child_data, notifications, next_notification)
+        next_notification: id to load more notifications after, or None"""
 
-    user.points -= reward.cost
-    message = f'{user.first_name} has purchased {reward.name}'
-    new_notification = ParentNotification(type='reward', message=message,
-        parent_id=user.parent_id, child_id=user.id, reward_id=reward.id)
-    db.session.add(new_notification)
-    db_commit()
-    return user
+    child_data = db.session.execute(
+        db.select(Child.username, Child.first_name, Child.points,
+            func.count(AssignedChore.id).label('chores'))
+        .outerjoin(AssignedChore, AssignedChore.user_id == Child.id)
+        .where(Child.parent_id == parent_id)
+        .group_by(Child.id)
+        .order_by(Child.id)).all()
+
+    notifications, next_notification = load_notifications(ParentNotification, parent_id)
+
+    return child_data, notifications, next_notification
+
+def load_notifications(model, owner_id, after=None, limit=NOTIFICATION_PAGE_SIZE):
+    """Load a page of a parent's or child's notifications, oldest first,
+    continuing after notification id `after`
+    Args: (model, owner_id, after, limit)
+        model: ParentNotification or ChildNotification
+    Returns: (notifications, id to continue after, or None if no more)"""
+
+    owner = model.parent_id if model is ParentNotification else model.child_id
+    statement = db.select(model).where(owner == owner_id).order_by(model.id) \
+        .limit(limit + 1)
+    if after is not None:
+        statement = statement.where(model.id > after)
+    notifications = db.session.execute(statement).scalars().all()
+    if len(notifications) > limit:
+        return notifications[:limit], notifications[limit - 1].id
+    return notifications, None
+
+def load_chore_pages(child_ids, after=None, limit=CHORE_PAGE_SIZE):
+    """Load the first page of assigned chores for each child in one query,
+    or the page after assigned chore id `after` for a single child
+    Args: (child_ids, after, limit)
+    Returns: dict of child id to (list of ChoreRow, id to continue after or None)"""
+
+    if not child_ids:
+        return {}
+
+    conditions = [AssignedChore.user_id.in_(list(child_ids))]
+    if after is not None:
+        conditions.append(AssignedChore.id > after)
+    position = func.row_number().over(partition_by=AssignedChore.user_id,
+        order_by=AssignedChore.id).label('position')
+    numbered = (db.select(AssignedChore.id, Chore.name, Chore.value,
+            AssignedChore.state, AssignedChore.user_id, position)
+        .join(Chore, Chore.id == AssignedChore.chore_id)
+        .where(*conditions).subquery())
+    rows = db.session.execute(db.select(numbered)
+        .where(numbered.c.position <= limit + 1)
+        .order_by(numbered.c.user_id, numbered.c.id))
+
+    chores = {child_id: [] for child_id in child_ids}
+    for row in rows:
+        chores[row.user_id].append(ChoreRow._make(row[:5]))
+    pages = {}
+    for child_id, rows in chores.items():
+        if len(rows) > limit:
+            pages[child_id] = (rows[:limit], rows[limit - 1].id)
+        else:
+            pages[child_id] = (rows, None)
+    return pages
+
+def fragment(html, next_url=None):
+    """Response to a load more request: the next slice of a list as HTML,
+    with the URL of the slice after it in the X-Next-URL header
+    Args: (html, next_url)"""
+
+    response = make_response(html)
+    if next_url:
+        response.headers['X-Next-URL'] = next_url
+    return response
+
+def family_id(user):
+    """Parent id of user's family
+    Args: (user)"""
+
+    return user.id if user.type == 'parent' else user.parent_id
+
+def family_version():
+    """Current data version of logged in user's family, read once per
+    request. Pages and fragments keyed on it show the logged in user's
+    values, so a user cached before the version changed is reloaded"""
+
+    if 'family_version' not in g:
+        g.family_version = db.session.execute(db.select(Parent.data_version)
+            .where(Parent.id == family_id(current_user))).scalar()
+        refresh_stale_user(g.family_version)
+    return g.family_version
+
+def page_etag():
+    """ETag for the current page. Changes with the family's data version,
+    the user, the session's CSRF token and its expiry window, and the
+    deployed release, so a cached page never holds stale data or forms
+    that would fail validation. Returns None if no CSRF token exists yet"""
+
+    csrf_token = session.get('csrf_token')
+    if csrf_token is None:
+        return None
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    window = int(time() // (time_limit / 2)) if time_limit else 0
+    key = (f'{request.full_path}:{current_user.type}:{current_user.id}:{family_version()}:'
+        f'{csrf_token}:{window}:{current_app.config["ETAG_SALT"]}')
+    return sha1(key.encode()).hexdigest()
+
+def family_etag(view):
+    """Answer GET requests for a page with 304 Not Modified while the
+    family's data is unchanged. Pages with pending flash messages are
+    always rendered"""
+
+    @wraps(view)
+    def decorated_view(*args, **kwargs):
+        if request.method != 'GET' or '_flashes' in session:
+            return view(*args, **kwargs)
+
+        etag = page_etag()
+        if etag is not None and request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            # Token is created while rendering a user's first page
+            etag = etag or page_etag()
+        if etag is not None:
+            response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+    return decorated_view
 
 def flash_errors(form):
     """Flash form errors to template.
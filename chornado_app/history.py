@@ -0,0 +1,85 @@
+import csv
+from datetime import date, datetime
+from io import StringIO
+
+from .sql_models import db, ActivityLog
+
+# Activity rows per history page, and per query when streaming a report
+PAGE_SIZE = 50
+REPORT_BATCH_SIZE = 500
+
+def month_bounds(month):
+    """First day of month and of the month after, for a YYYY-MM string.
+    Defaults to the current month if month is missing or invalid
+    Args: (month)
+    Returns: (start, end)"""
+
+    try:
+        start = datetime.strptime(month or '', '%Y-%m')
+    except ValueError:
+        start = datetime.combine(date.today().replace(day=1), datetime.min.time())
+    if start.month == 12:
+        return start, start.replace(year=start.year + 1, month=1)
+    return start, start.replace(month=start.month + 1)
+
+def encode_cursor(entry):
+    """Position after entry in a newest-first history
+    Args: (entry)"""
+
+    return f'{entry.created_at.isoformat()}_{entry.id}'
+
+def decode_cursor(cursor):
+    """Returns (created_at, id) of a cursor, or None if it isn't valid
+    Args: (cursor)"""
+
+    try:
+        created_at, entry_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(entry_id)
+    except (AttributeError, ValueError):
+        return None
+
+def activity_page(parent_id, start, end, cursor=None, limit=PAGE_SIZE):
+    """One page of a family's activity between start and end, newest first.
+    Pages continue from the cursor with an index range scan rather than an
+    OFFSET, so every page costs the same
+    Args: (parent_id, start, end, cursor, limit)
+    Returns: (entries, cursor of the next page or None)"""
+
+    statement = (db.select(ActivityLog)
+        .where(ActivityLog.parent_id == parent_id, ActivityLog.created_at >= start,
+            ActivityLog.created_at < end)
+        .order_by(ActivityLog.created_at.desc(), ActivityLog.id.desc())
+        .limit(limit + 1))
+    position = decode_cursor(cursor)
+    if position is not None:
+        statement = statement.where(db.tuple_(ActivityLog.created_at, ActivityLog.id)
+            < db.tuple_(*position))
+
+    entries = db.session.execute(statement).scalars().all()
+    if len(entries) > limit:
+        return entries[:limit], encode_cursor(entries[limit - 1])
+    return entries, None
+
+def activity_csv(parent_id, start, end):
+    """Yield a family's activity between start and end as CSV, reading one
+    page of rows at a time
+    Args: (parent_id, start, end)"""
+
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['time', 'child', 'action', 'item', 'points'])
+    cursor = None
+    while True:
+        entries, cursor = activity_page(parent_id, start, end, cursor,
+            REPORT_BATCH_SIZE)
+        for entry in entries:
+            writer.writerow([entry.created_at.isoformat(sep=' ', timespec='seconds'),
+                entry.child_name, entry.action, entry.item, entry.points])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        # Rows already written are not kept in the session
+        for entry in entries:
+            db.session.expunge(entry)
+        if cursor is None:
+            break
@@ -0,0 +1,191 @@
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from .sql_models import db
+
+# Versioned schema changes for databases created before the matching model
+# change. Each entry is (version, description, statements). Statements must
+# be safe to run against tables already created by db.create_all(), which
+# upgrade() runs first, so new tables only need a migration for backfills.
+MIGRATIONS = [
+    (1, 'Account table indexing usernames across parent and child users', [
+        '''CREATE TABLE IF NOT EXISTS account (
+            username VARCHAR(64) NOT NULL PRIMARY KEY,
+            type VARCHAR(8) NOT NULL,
+            parent_id INTEGER UNIQUE REFERENCES parent (id) ON DELETE CASCADE,
+            child_id INTEGER UNIQUE REFERENCES child (id) ON DELETE CASCADE,
+            CONSTRAINT account_one_user CHECK ((parent_id IS NULL) <> (child_id IS NULL))
+        )''',
+        # Parents are added first, matching the login order they replace
+        '''INSERT INTO account (username, type, parent_id)
+            SELECT username, 'parent', id FROM parent
+            WHERE NOT EXISTS (SELECT 1 FROM account
+                WHERE account.username = parent.username)''',
+        '''INSERT INTO account (username, type, child_id)
+            SELECT username, 'child', id FROM child
+            WHERE NOT EXISTS (SELECT 1 FROM account
+                WHERE account.username = child.username)''',
+    ]),
+    (2, 'Indexes on foreign keys and hot query paths', [
+        'CREATE INDEX IF NOT EXISTS ix_child_parent_id ON child (parent_id)',
+        'CREATE INDEX IF NOT EXISTS ix_chore_parent_id ON chore (parent_id)',
+        'CREATE INDEX IF NOT EXISTS ix_reward_parent_id ON reward (parent_id)',
+        '''CREATE INDEX IF NOT EXISTS ix_assigned_chore_user_id_id
+            ON assigned_chore (user_id, id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_assigned_chore_user_id_chore_id
+            ON assigned_chore (user_id, chore_id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_assigned_chore_chore_id
+            ON assigned_chore (chore_id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_parent_notification_parent_id_id
+            ON parent_notification (parent_id, id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_parent_notification_child_id
+            ON parent_notification (child_id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_parent_notification_chore_id
+            ON parent_notification (chore_id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_parent_notification_reward_id
+            ON parent_notification (reward_id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_child_notification_child_id_id
+            ON child_notification (child_id, id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_child_notification_chore_id
+            ON child_notification (chore_id)''',
+        '''CREATE INDEX IF NOT EXISTS ix_child_notification_reward_id
+            ON child_notification (reward_id)''',
+    ]),
+    (3, 'Family data version counter', [
+        '''ALTER TABLE parent ADD COLUMN IF NOT EXISTS
+            data_version INTEGER NOT NULL DEFAULT 0''',
+    ]),
+    (4, 'Opening points ledger entries for existing children', [
+        '''INSERT INTO points_ledger (child_id, delta, balance, reason)
+            SELECT id, points, points, 'Opening balance' FROM child
+            WHERE points <> 0 AND NOT EXISTS (SELECT 1 FROM points_ledger
+                WHERE points_ledger.child_id = child.id)''',
+    ]),
+    (5, 'Notification timestamps, and one notification per assigned chore', [
+        # Existing notifications expire a full retention period from now
+        '''ALTER TABLE parent_notification ADD COLUMN IF NOT EXISTS
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP''',
+        '''ALTER TABLE child_notification ADD COLUMN IF NOT EXISTS
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP''',
+        # Keep the newest of any duplicates before adding the unique indexes
+        '''DELETE FROM parent_notification AS older USING parent_notification AS newer
+            WHERE older.chore_id = newer.chore_id AND older.parent_id = newer.parent_id
+                AND older.type = newer.type AND older.id < newer.id''',
+        '''DELETE FROM child_notification AS older USING child_notification AS newer
+            WHERE older.chore_id = newer.chore_id AND older.child_id = newer.child_id
+                AND older.type = newer.type AND older.id < newer.id''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS uq_parent_notification_chore_id_parent_id_type
+            ON parent_notification (chore_id, parent_id, type)''',
+        '''CREATE UNIQUE INDEX IF NOT EXISTS uq_child_notification_chore_id_child_id_type
+            ON child_notification (chore_id, child_id, type)''',
+        '''CREATE INDEX IF NOT EXISTS ix_parent_notification_created_at
+            ON parent_notification (created_at)''',
+        '''CREATE INDEX IF NOT EXISTS ix_child_notification_created_at
+            ON child_notification (created_at)''',
+    ]),
+    (6, 'Delete family rows with ON DELETE CASCADE', [
+        '''ALTER TABLE child
+            DROP CONSTRAINT IF EXISTS child_parent_id_fkey,
+            ADD CONSTRAINT child_parent_id_fkey FOREIGN KEY (parent_id)
+                REFERENCES parent (id) ON DELETE CASCADE''',
+        '''ALTER TABLE chore
+            DROP CONSTRAINT IF EXISTS chore_parent_id_fkey,
+            ADD CONSTRAINT chore_parent_id_fkey FOREIGN KEY (parent_id)
+                REFERENCES parent (id) ON DELETE CASCADE''',
+        '''ALTER TABLE reward
+            DROP CONSTRAINT IF EXISTS reward_parent_id_fkey,
+            ADD CONSTRAINT reward_parent_id_fkey FOREIGN KEY (parent_id)
+                REFERENCES parent (id) ON DELETE CASCADE''',
+        '''ALTER TABLE assigned_chore
+            DROP CONSTRAINT IF EXISTS assigned_chore_chore_id_fkey,
+            ADD CONSTRAINT assigned_chore_chore_id_fkey FOREIGN KEY (chore_id)
+                REFERENCES chore (id) ON DELETE CASCADE''',
+        '''ALTER TABLE assigned_chore
+            DROP CONSTRAINT IF EXISTS assigned_chore_user_id_fkey,
+            ADD CONSTRAINT assigned_chore_user_id_fkey FOREIGN KEY (user_id)
+                REFERENCES child (id) ON DELETE CASCADE''',
+        '''ALTER TABLE chore_schedule
+            DROP CONSTRAINT IF EXISTS chore_schedule_chore_id_fkey,
+            ADD CONSTRAINT chore_schedule_chore_id_fkey FOREIGN KEY (chore_id)
+                REFERENCES chore (id) ON DELETE CASCADE''',
+        '''ALTER TABLE chore_schedule
+            DROP CONSTRAINT IF EXISTS chore_schedule_user_id_fkey,
+            ADD CONSTRAINT chore_schedule_user_id_fkey FOREIGN KEY (user_id)
+                REFERENCES child (id) ON DELETE CASCADE''',
+        '''ALTER TABLE parent_notification
+            DROP CONSTRAINT IF EXISTS parent_notification_parent_id_fkey,
+            ADD CONSTRAINT parent_notification_parent_id_fkey FOREIGN KEY (parent_id)
+                REFERENCES parent (id) ON DELETE CASCADE''',
+        '''ALTER TABLE parent_notification
+            DROP CONSTRAINT IF EXISTS parent_notification_reward_id_fkey,
+            ADD CONSTRAINT parent_notification_reward_id_fkey FOREIGN KEY (reward_id)
+                REFERENCES reward (id) ON DELETE CASCADE''',
+        '''ALTER TABLE parent_notification
+            DROP CONSTRAINT IF EXISTS parent_notification_chore_id_fkey,
+            ADD CONSTRAINT parent_notification_chore_id_fkey FOREIGN KEY (chore_id)
+                REFERENCES assigned_chore (id) ON DELETE CASCADE''',
+        # child_id had no foreign key. Notifications of children deleted
+        # outside the app would block it
+        '''DELETE FROM parent_notification WHERE NOT EXISTS (SELECT 1 FROM child
+            WHERE child.id = parent_notification.child_id)''',
+        '''ALTER TABLE parent_notification
+            DROP CONSTRAINT IF EXISTS parent_notification_child_id_fkey,
+            ADD CONSTRAINT parent_notification_child_id_fkey FOREIGN KEY (child_id)
+                REFERENCES child (id) ON DELETE CASCADE''',
+        '''ALTER TABLE child_notification
+            DROP CONSTRAINT IF EXISTS child_notification_child_id_fkey,
+            ADD CONSTRAINT child_notification_child_id_fkey FOREIGN KEY (child_id)
+                REFERENCES child (id) ON DELETE CASCADE''',
+        '''ALTER TABLE child_notification
+            DROP CONSTRAINT IF EXISTS child_notification_reward_id_fkey,
+            ADD CONSTRAINT child_notification_reward_id_fkey FOREIGN KEY (reward_id)
+                REFERENCES reward (id) ON DELETE CASCADE''',
+        '''ALTER TABLE child_notification
+            DROP CONSTRAINT IF EXISTS child_notification_chore_id_fkey,
+            ADD CONSTRAINT child_notification_chore_id_fkey FOREIGN KEY (chore_id)
+                REFERENCES assigned_chore (id) ON DELETE CASCADE''',
+    ]),
+]
+
+def applied_versions(connection):
+    """Return set of migration versions already applied
+    Args: (connection)"""
+
+    connection.execute(text('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER NOT NULL PRIMARY KEY,
+        description VARCHAR(256) NOT NULL,
+        applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)'''))
+    return set(connection.execute(text('SELECT version FROM schema_version')).scalars())
+
+def upgrade():
+    """Create missing tables and apply pending migrations, each in its
+    own transaction. Returns list of applied (version, description)"""
+
+    db.create_all()
+    applied = []
+    with db.engine.begin() as connection:
+        done = applied_versions(connection)
+
+    for version, description, statements in MIGRATIONS:
+        if version in done:
+            continue
+        with db.engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+            connection.execute(text('INSERT INTO schema_version (version, description) '
+                'VALUES (:version, :description)'),
+                {'version': version, 'description': description})
+        applied.append((version, description))
+    return applied
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db_command():
+    """Create tables and apply pending schema migrations"""
+
+    applied = upgrade()
+    for version, description in applied:
+        click.echo(f'Applied migration {version}: {description}')
+    if not applied:
+        click.echo('Database is up to date')
@@ -0,0 +1,103 @@
+import json
+from datetime import datetime, timedelta
+from time import sleep
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .sql_models import db, Child, ParentNotification, ChildNotification
+from .helpers import db_commit, touch_family
+
+# Notifications deleted per transaction, so each purge only briefly locks
+# a small number of rows
+PURGE_BATCH_SIZE = 500
+
+def notification_family(model):
+    """Column holding the parent id of a notification's family
+    Args: (model)"""
+
+    if model is ParentNotification:
+        return model.parent_id
+    return db.select(Child.parent_id).where(Child.id == model.child_id) \
+        .scalar_subquery()
+
+def archive_record(notification):
+    """Notification as an archive record
+    Args: (notification)"""
+
+    record = {'table': notification.__table__.name}
+    for column in notification.__table__.columns.keys():
+        value = getattr(notification, column)
+        record[column] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+def purge_batch(model, cutoff, batch_size, archive=None):
+    """Delete up to batch_size of model's notifications created before
+    cutoff, in one transaction, then archive them. Rows locked by a
+    request are skipped and left for the next run.
+    Args: (model, cutoff, batch_size, archive)
+        archive: file to write deleted notifications to as NDJSON
+    Returns: number of notifications deleted"""
+
+    rows = db.session.execute(db.select(model, notification_family(model))
+        .where(model.created_at < cutoff)
+        .order_by(model.id).limit(batch_size)
+        .with_for_update(of=model, skip_locked=True)).all()
+    if not rows:
+        return 0
+
+    records = [archive_record(notification) for notification, _ in rows]
+    for _, parent_id in rows:
+        touch_family(parent_id)
+    db.session.execute(db.delete(model)
+        .where(model.id.in_([record['id'] for record in records]))
+        .execution_options(synchronize_session=False))
+    if not db_commit():
+        return 0
+    db.session.expunge_all()
+    # Only notifications that were deleted are archived, so a failed
+    # batch isn't archived again by the next run
+    if archive is not None:
+        for record in records:
+            archive.write(json.dumps(record) + '\n')
+    return len(rows)
+
+def purge_notifications(cutoff, batch_size=PURGE_BATCH_SIZE, pause=0, archive=None):
+    """Delete parent and child notifications created before cutoff, a
+    batch per transaction
+    Args: (cutoff, batch_size, pause, archive)
+        pause: seconds to wait between batches
+    Returns: dict of table name to number deleted"""
+
+    purged = {}
+    for model in (ParentNotification, ChildNotification):
+        total = 0
+        while True:
+            count = purge_batch(model, cutoff, batch_size, archive)
+            total += count
+            if count < batch_size:
+                break
+            if archive is not None:
+                archive.flush()
+            sleep(pause)
+        purged[model.__table__.name] = total
+    return purged
+
+@click.command('purge-notifications')
+@click.option('--days', type=int, help='Delete notifications older than DAYS. '
+    'Defaults to NOTIFICATION_TTL_DAYS.')
+@click.option('--batch-size', default=PURGE_BATCH_SIZE,
+    help='Notifications deleted per transaction.')
+@click.option('--pause', default=0.1, help='Seconds to wait between batches.')
+@click.option('--archive', type=click.File('a'),
+    help='Append deleted notifications to this file as NDJSON.')
+@with_appcontext
+def purge_notifications_command(days, batch_size, pause, archive):
+    """Delete expired notifications in small batches"""
+
+    if days is None:
+        days = current_app.config['NOTIFICATION_TTL_DAYS']
+    cutoff = datetime.now() - timedelta(days=days)
+    purged = purge_notifications(cutoff, batch_size, pause, archive)
+    for name, count in purged.items():
+        click.echo(f'{name}: {count} older than {days} days deleted')
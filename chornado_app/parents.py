@@ -1,41 +1,62 @@
-from flask import redirect, render_template, request, Blueprint, flash
+from datetime import date, timedelta
+from flask import (redirect, render_template, request, Blueprint, flash, url_for,
+    Response, stream_with_context)
 from flask_login import login_required, current_user
-from werkzeug.security import check_password_hash, generate_password_hash
 
 from .forms import (AssignedChoreForm, RewardForm, ChildRegForm, PointsForm,
-    ChoreForm, ParentResetPasswordForm)
-from .sql_models import (db, Child, AssignedChore, Chore, Reward,
-    ParentNotification, ChildNotification)
+    ChoreForm, BulkAssignForm, ScheduleForm, RemoveScheduleForm,
+    ParentResetPasswordForm)
+from .sql_models import (db, Child, Chore, Reward, ParentNotification)
+from .scheduler import (schedule_chore, remove_schedule, load_schedules,
+    weekday_mask)
+from .passwords import (hash_password, verify_password)
+from .points import change_points
+from .services import (approve_chore, reject_chore, remove_assigned_chore,
+    deliver_reward)
+from .transfer import EXPORT_FORMATS
+from .history import month_bounds, activity_page, activity_csv
 from .helpers import (db_commit, redirect_url, register_child, flash_errors,
-    approve_completed, reject_completed, create_chore, assign_chore, edit_chore,
-    create_reward, edit_reward)
+    create_chore, assign_chore, edit_chore, create_reward, edit_reward, load_dashboard,
+    load_notifications, load_chore_pages, invalidate_user, bulk_assign_chores,
+    family_etag, fragment)
 
 parent_bp = Blueprint('parent', __name__, url_prefix="/parent")
 
 @parent_bp.route('/home')
 @login_required
+@family_etag
 def home():
     """Parents homepage"""
 
-    parent = current_user
-    child_data = []
-    # Get list of notifications for user
-    notifications = parent.notifications
+    # Child summaries with chore counts, and notifications for user
+    child_data, notifications, next_notification = load_dashboard(current_user.id)
     chore_form = AssignedChoreForm()
     reward_form = RewardForm()
 
-    # Create list of dictionaries of data for children
-    # and count of the chores assigned to them
-    for child in parent.children:
-        chores = child.assigned_chores.count()
-        child_dict = {'username': child.username, 'first_name': child.first_name,
-        'points': child.points, 'chores': chores}
-        child_data.append(child_dict)
     return render_template('parents/home.html', child_data=child_data,
-        notifications=notifications, chore_form=chore_form, reward_form=reward_form)
+        notifications=notifications, next_notification=next_notification,
+        chore_form=chore_form, reward_form=reward_form)
+
+@parent_bp.route('/notifications')
+@login_required
+def more_notifications():
+    """Notifications after the ?after= notification id, as list items for
+    the home page's load more button"""
+
+    if current_user.type != 'parent':
+        return redirect(url_for('routes.index'))
+
+    notifications, next_notification = load_notifications(ParentNotification,
+        current_user.id, request.args.get('after', type=int))
+    next_url = next_notification and url_for('parent.more_notifications',
+        after=next_notification)
+    return fragment(render_template('parents/_notification_items.html',
+        notifications=notifications, chore_form=AssignedChoreForm(),
+        reward_form=RewardForm()), next_url)
 
 @parent_bp.route('/children', methods=['GET', 'POST'])
 @login_required
+@family_etag
 def children():
     """Parent's children page for listing and creating child accounts"""
 
@@ -50,15 +71,22 @@ def children():
             password = register_form.password.data
             first_name = register_form.first_name.data
             register_child(username, password, first_name)
-            flash(f'Account created for {first_name}', 'success')
-            db_commit()
+            # Fails if username was taken by a concurrent registration
+            if db_commit():
+                flash(f'Account created for {first_name}', 'success')
+            else:
+                flash('Username already exists', 'error')
             return redirect(redirect_url())
 
         # Adjust child's points
         if points_form.validate() and points_form.adjust.data:
-            child = Child.query.get(points_form.child_id.data)
+            child = Child.query.filter_by(id=points_form.child_id.data,
+                parent_id=current_user.id).first()
+            # Only parents can adjust points, and only for their own children
+            if current_user.type != 'parent' or child is None:
+                return redirect(redirect_url())
             new_points = points_form.points.data
-            child.points += new_points
+            change_points(child, new_points, 'Adjusted by parent')
             if new_points < 0:
                 new_points = -new_points
                 flash(f"{new_points} points removed from {child.first_name}'s account.",
@@ -67,69 +95,118 @@ def children():
                 flash(f"{new_points} points added to {child.first_name}'s account.",
                     'success')
             db_commit()
+            invalidate_user(child.username)
             return redirect(redirect_url())
 
         # Check if chore_form is being submitted
         if (chore_form.validate() and (chore_form.delete.data
             or chore_form.approve.data or chore_form.reject.data)):
 
-            current_chore = AssignedChore.query.get(chore_form.chore_id.data)
-            chore_info = Chore.query.get(current_chore.chore_id)
-            child = Child.query.get(current_chore.user_id)
+            chore_id = chore_form.chore_id.data
 
             # Approve completed chore, assign points, and delete assigned chore
             if chore_form.approve.data:
-                new_points = chore_info.value
-                approve_completed(current_chore, child, new_points)
-                flash(f'{chore_info.name} complete!', 'success')
+                result = approve_chore(chore_id, current_user.id)
+                if result is not None:
+                    flash(f'{result.item} complete!', 'success')
 
             # Delete assigned chore
             elif chore_form.delete.data:
-                db.session.delete(current_chore)
-                flash(f'{chore_info.name} has been removed for {child.first_name}', 'success')
+                result = remove_assigned_chore(chore_id, current_user.id)
+                if result is not None:
+                    flash(f'{result.item} has been removed for {result.first_name}',
+                        'success')
 
             # Reject completed chore, and set status back to active
             elif chore_form.reject.data:
-                reject_completed(current_chore)
-                flash(f'{chore_info.name} has been sent back to {child.first_name}', 'success')
-            db_commit()
+                result = reject_chore(chore_id, current_user.id)
+                if result is not None:
+                    flash(f'{result.item} has been sent back to {result.first_name}',
+                        'success')
             return redirect(redirect_url())
 
         flash_errors(register_form)
         flash_errors(chore_form)
         return redirect(redirect_url())
 
-    children = current_user.children
+    children = current_user.children.all()
+    chore_pages = load_chore_pages([child.id for child in children])
     child_data = []
 
     # Create list of dictionaries of data for children
-    # and the chores assigned to them
+    # and the first page of chores assigned to them
     for child in children:
-        chores = []
-        assigned_chores = child.assigned_chores.order_by(AssignedChore.id)
-        for assigned_chore in assigned_chores:
-            chore_info = Chore.query.get(assigned_chore.chore_id)
-            chore_dict = {'id': assigned_chore.id, 'name': chore_info.name,
-                'points': chore_info.value, 'state': assigned_chore.state}
-
-            chores.append(chore_dict)
-
+        chores, next_chore = chore_pages[child.id]
         child_dict = {'username': child.username, 'first_name': child.first_name,
-            'points': child.points, 'id': child.id, 'chores': chores, 'count': len(chores)}
+            'points': child.points, 'id': child.id, 'chores': chores, 'next': next_chore}
 
         child_data.append(child_dict)
 
     return render_template('parents/children.html', template_form=register_form,
     points_form=points_form, chore_form=chore_form, child_data=child_data)
 
+@parent_bp.route('/children/<int:child_id>/chores')
+@login_required
+def more_chores(child_id):
+    """Child's assigned chores after the ?after= assigned chore id, as table
+    rows for the children page's load more button"""
+
+    child = Child.query.filter_by(id=child_id, parent_id=current_user.id).first()
+    if current_user.type != 'parent' or child is None:
+        return redirect(url_for('routes.index'))
+
+    chores, next_chore = load_chore_pages([child.id],
+        request.args.get('after', type=int))[child.id]
+    next_url = next_chore and url_for('parent.more_chores', child_id=child.id,
+        after=next_chore)
+    return fragment(render_template('parents/_child_chore_rows.html', chores=chores,
+        chore_form=AssignedChoreForm()), next_url)
+
 @parent_bp.route('/chores', methods=['GET', 'POST'])
 @login_required
+@family_etag
 def parent_chores():
     """Parent's chore page for creating, viewing, editing, and assigning chores"""
 
     parent = current_user
-    child_count = parent.children.count()
     form = ChoreForm()
+    child_count = len(form.child.choices)
+    chores = parent.chores.order_by(Chore.name).all()
+    bulk_form = BulkAssignForm()
+    bulk_form.chores.choices = [(chore.id, chore.name) for chore in chores]
+    bulk_form.children.choices = form.child.choices
+    schedule_form = ScheduleForm()
+    schedule_form.schedule_chore.choices = bulk_form.chores.choices
+    schedule_form.schedule_child.choices = form.child.choices
+    remove_schedule_form = RemoveScheduleForm()
+
+    # Assign chore to child on recurring days
+    if request.method == 'POST' and schedule_form.schedule.data:
+        if schedule_form.validate():
+            schedule_chore(schedule_form.schedule_chore.data,
+                schedule_form.schedule_child.data, weekday_mask(schedule_form.days.data))
+            db_commit()
+            flash('Chore scheduled', 'success')
+        flash_errors(schedule_form)
+        return redirect(redirect_url())
+
+    # Remove recurring chore
+    if request.method == 'POST' and remove_schedule_form.unschedule.data:
+        if remove_schedule_form.validate():
+            remove_schedule(remove_schedule_form.schedule_id.data, parent.id)
+            db_commit()
+            flash('Scheduled chore removed', 'success')
+        return redirect(redirect_url())
+
+    # Assign selected chores to selected children
+    if request.method == 'POST' and bulk_form.bulk_assign.data:
+        if bulk_form.validate():
+            count = bulk_assign_chores(bulk_form.chores.data, bulk_form.children.data,
+                parent.id)
+            db_commit()
+            flash(f'{count} chores assigned', 'success')
+        flash_errors(bulk_form)
+        return redirect(redirect_url())
 
     if request.method == 'POST' and form.validate_on_submit():
         name = form.name.data
@@ -159,11 +236,14 @@ def parent_chores():
         return redirect(redirect_url())
 
     flash_errors(form)
-    chores = parent.chores.order_by(Chore.name)
-    return render_template('parents/chores.html', template_form=form, chores=chores, child_count=child_count)
+    schedules = load_schedules(parent.id)
+    return render_template('parents/chores.html', template_form=form, chores=chores,
+        child_count=child_count, bulk_form=bulk_form, schedule_form=schedule_form,
+        remove_schedule_form=remove_schedule_form, schedules=schedules)
 
 @parent_bp.route('/rewards', methods=['GET', 'POST'])
 @login_required
+@family_etag
 def parent_rewards():
     """Route for viewing, creating, and editing rewards"""
 
@@ -181,13 +261,9 @@ def parent_rewards():
         elif form.delete.data:
             db.session.delete(reward)
         elif form.deliver.data:
-            notification = ParentNotification.query.get(form.notification_id.data)
-            db.session.delete(notification)
-            message = f'You have been given {reward.name}!'
-            new_notification = ChildNotification(type='reward', message=message,
-                child_id=notification.child_id, reward_id=notification.reward_id)
-            db.session.add(new_notification)
-            flash('Reward delivered', 'success')
+            if deliver_reward(form.notification_id.data, parent.id) is not None:
+                flash('Reward delivered', 'success')
+            return redirect(redirect_url())
         db_commit()
         return redirect(redirect_url())
 
@@ -196,6 +272,38 @@ def parent_rewards():
     return render_template('parents/rewards.html', template_form=form,
     rewards=rewards)
 
+@parent_bp.route('/history')
+@login_required
+@family_etag
+def history():
+    """Family's chore and reward history, a month and page at a time"""
+
+    if current_user.type != 'parent':
+        return redirect(url_for('routes.index'))
+
+    start, end = month_bounds(request.args.get('month'))
+    entries, next_cursor = activity_page(current_user.id, start, end,
+        request.args.get('after'))
+    previous_month = (start.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
+    return render_template('parents/history.html', entries=entries,
+        next_cursor=next_cursor, month=start.strftime('%Y-%m'),
+        month_name=start.strftime('%B %Y'), previous_month=previous_month,
+        next_month=end.strftime('%Y-%m'))
+
+@parent_bp.route('/history.csv')
+@login_required
+def history_csv():
+    """Download a month of family history as CSV"""
+
+    if current_user.type != 'parent':
+        return redirect(url_for('routes.index'))
+
+    start, end = month_bounds(request.args.get('month'))
+    filename = f'chornado-history-{start:%Y-%m}.csv'
+    return Response(stream_with_context(activity_csv(current_user.id, start, end)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 @parent_bp.route('/settings', methods=['POST', 'GET'])
 @login_required
 def settings():
@@ -206,13 +314,11 @@ def settings():
 
     if request.method == 'POST' and form.validate_on_submit():
         old_password = form.old_password.data
-        if check_password_hash(parent.password_hash, old_password):
+        if verify_password(parent.password_hash, old_password):
             new_password = form.new_password.data
-            new_hash = generate_password_hash(new_password,
-                method='pbkdf2:sha256', salt_length=8)
-
-            parent.password_hash = new_hash
+            parent.password_hash = hash_password(new_password)
             db_commit()
+            invalidate_user(parent.username)
             flash('Password changed','success')
         else:
             flash('Please enter correct old password.', 'error')
@@ -220,3 +326,20 @@ def settings():
 
     flash_errors(form)
     return render_template('parents/settings.html', parent=parent, template_form=form)
+
+@parent_bp.route('/export')
+@login_required
+def export():
+    """Download family's data as CSV or NDJSON, without password hashes"""
+
+    if current_user.type != 'parent':
+        return redirect(url_for('routes.index'))
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        export_format = 'csv'
+    export_rows, mimetype = EXPORT_FORMATS[export_format]
+    filename = f'chornado-family-{date.today()}.{export_format}'
+    return Response(stream_with_context(export_rows(current_user.id,
+        include_passwords=False)), mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'})
@@ -0,0 +1,78 @@
+from concurrent.futures import ProcessPoolExecutor
+from os import getpid
+from threading import BoundedSemaphore, Lock
+from flask import current_app, flash, redirect, request, url_for
+from werkzeug.security import check_password_hash, generate_password_hash
+
+class HashingBusy(Exception):
+    """Raised when the password hashing queue is full"""
+
+# Executor and queue slots are created per worker process after fork
+_pool = {'pid': None, 'executor': None, 'slots': None}
+_pool_lock = Lock()
+
+def _get_pool():
+    """Return (executor, slots) for this process, creating them on first use"""
+
+    with _pool_lock:
+        if _pool['pid'] != getpid():
+            config = current_app.config
+            _pool['executor'] = ProcessPoolExecutor(
+                max_workers=config['PASSWORD_HASH_WORKERS'])
+            _pool['slots'] = BoundedSemaphore(config['PASSWORD_HASH_QUEUE'])
+            _pool['pid'] = getpid()
+        return _pool['executor'], _pool['slots']
+
+def _run(func, *args):
+    """Run hashing function in the process pool, or inline if disabled.
+    Raises HashingBusy if no queue slot frees up within the timeout.
+    Args: (func, *args)"""
+
+    config = current_app.config
+    if not config['PASSWORD_HASH_WORKERS']:
+        return func(*args)
+
+    executor, slots = _get_pool()
+    if not slots.acquire(timeout=config['PASSWORD_HASH_TIMEOUT']):
+        raise HashingBusy()
+    try:
+        return executor.submit(func, *args).result()
+    finally:
+        slots.release()
+
+def hash_password(password):
+    """Hash password with the configured method
+    Args: (password)"""
+
+    return _run(generate_password_hash, password,
+        current_app.config['PASSWORD_HASH_METHOD'], 8)
+
+def verify_password(pw_hash, password):
+    """Check password against stored hash
+    Args: (pw_hash, password)"""
+
+    return _run(check_password_hash, pw_hash, password)
+
+def needs_rehash(pw_hash):
+    """Returns true if hash was not made with the configured method
+    Args: (pw_hash)"""
+
+    return pw_hash.split('$', 1)[0] != current_app.config['PASSWORD_HASH_METHOD']
+
+def init_password_hashing(app):
+    """Set hashing defaults and handle a full hashing queue
+    Args: (app)"""
+
+    # Method string includes the work factor, e.g. pbkdf2:sha256:260000
+    app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+    # Number of hashing processes per worker, 0 hashes inline
+    app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+    # Hashes allowed to run or wait per worker before rejecting requests
+    app.config.setdefault('PASSWORD_HASH_QUEUE', 8)
+    # Seconds to wait for a queue slot
+    app.config.setdefault('PASSWORD_HASH_TIMEOUT', 5)
+
+    @app.errorhandler(HashingBusy)
+    def hashing_busy(error):
+        flash('The server is busy, please try again in a moment.', 'error')
+        return redirect(request.referrer or url_for('routes.index'))
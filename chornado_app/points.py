@@ -0,0 +1,202 @@
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import exc, func
+from sqlalchemy.orm.attributes import set_committed_value
+
+from .sql_models import db, Account, Child, Parent, PointsEntry, Reward
+
+# Username prefix of the family created by stress-points
+STRESS_PREFIX = 'stress-points'
+
+def add_points(child_id, delta, reason, require_balance=False):
+    """Add delta to a child's points with a single conditional UPDATE, and
+    record the change in the points ledger. Concurrent changes can't
+    overwrite each other, and no row lock is held before the update.
+    Args: (child_id, delta, reason, require_balance)
+        require_balance: only remove points the child has
+    Returns: child's new points, or None if they didn't have enough"""
+
+    statement = (db.update(Child).where(Child.id == child_id)
+        .values(points=Child.points + delta).returning(Child.points)
+        .execution_options(synchronize_session=False))
+    if require_balance and delta < 0:
+        statement = statement.where(Child.points >= -delta)
+
+    balance = db.session.execute(statement).scalar()
+    if balance is None:
+        return None
+    db.session.add(PointsEntry(child_id=child_id, delta=delta, balance=balance,
+        reason=reason))
+    return balance
+
+def change_points(child, delta, reason, require_balance=False):
+    """add_points() for a loaded child, whose points are updated to match
+    Args: (child, delta, reason, require_balance)
+    Returns: child's new points, or None if they didn't have enough"""
+
+    balance = add_points(child.id, delta, reason, require_balance)
+    if balance is not None:
+        set_committed_value(child, 'points', balance)
+    return balance
+
+def ledger_mismatches():
+    """Children whose points don't match the total of their ledger entries.
+    Returns list of (child_id, username, points, ledger_total)"""
+
+    totals = (db.select(PointsEntry.child_id, func.sum(PointsEntry.delta).label('total'))
+        .group_by(PointsEntry.child_id).subquery())
+    ledger_total = func.coalesce(totals.c.total, 0)
+    rows = db.session.execute(
+        db.select(Child.id, Child.username, Child.points, ledger_total)
+        .outerjoin(totals, totals.c.child_id == Child.id)
+        .where(Child.points != ledger_total)
+        .order_by(Child.id))
+    return [tuple(row) for row in rows]
+
+@click.command('reconcile-points')
+@click.option('--fix', is_flag=True,
+    help='Reset mismatched points to their ledger total.')
+@with_appcontext
+def reconcile_points_command(fix):
+    """Check children's points against the points ledger"""
+
+    mismatches = ledger_mismatches()
+    for child_id, username, points, total in mismatches:
+        click.echo(f'{username} (id {child_id}): {points} points, ledger total {total}')
+        if fix:
+            db.session.execute(db.update(Child).where(Child.id == child_id)
+                .values(points=total))
+    if not mismatches:
+        click.echo('All points match the ledger')
+    elif fix:
+        # Cached pages of the fixed families are out of date
+        child_ids = [child_id for child_id, *_ in mismatches]
+        db.session.execute(db.update(Parent)
+            .where(Parent.id.in_(db.select(Child.parent_id).where(Child.id.in_(child_ids))))
+            .values(data_version=Parent.data_version + 1))
+        db.session.commit()
+        click.echo(f'Reset points for {len(mismatches)} children')
+    else:
+        raise click.ClickException(f'{len(mismatches)} children do not match the ledger')
+
+def stress_family(cost):
+    """Add a parent, a child with no points and a reward costing cost, for
+    stress-points. No one can log in as them
+    Args: (cost)
+    Returns: (parent_id, child_id, reward_id)"""
+
+    parent = Parent(username=f'{STRESS_PREFIX}@example.com', first_name='Stress',
+        last_name='Test', password_hash='!')
+    child = Child(username=f'{STRESS_PREFIX}-child', first_name='Stress',
+        password_hash='!', parent=parent, points=0)
+    reward = Reward(name='Stress reward', cost=cost, parent=parent)
+    db.session.add_all([parent, child, reward,
+        Account(username=parent.username, type='parent', parent=parent),
+        Account(username=child.username, type='child', child=child)])
+    db.session.commit()
+    return parent.id, child.id, reward.id
+
+def earn_points(app, child_id, rounds):
+    """Add a point at a time, each in its own transaction
+    Args: (app, child_id, rounds)
+    Returns: list of committed deltas"""
+
+    from .helpers import db_commit
+
+    applied = []
+    with app.app_context():
+        for _ in range(rounds):
+            try:
+                if add_points(child_id, 1, 'Stress test') is not None and db_commit():
+                    applied.append(1)
+            except exc.SQLAlchemyError:
+                db.session.rollback()
+    return applied
+
+def spend_points(app, child_id, reward_id, rounds):
+    """Purchase the reward repeatedly, as a child would
+    Args: (app, child_id, reward_id, rounds)
+    Returns: list of committed deltas"""
+
+    from .services import purchase_reward
+
+    applied = []
+    with app.app_context():
+        for _ in range(rounds):
+            try:
+                result = purchase_reward(db.session.get(Child, child_id), reward_id)
+            except exc.SQLAlchemyError:
+                db.session.rollback()
+                continue
+            if result is not None:
+                applied.append(result.points)
+    return applied
+
+def ledger_problems(child_id, applied):
+    """Ways a child's points and ledger disagree with the changes that were
+    committed: the balance, the ledger total and the number of entries must
+    match them, and every entry's balance must follow from the one before
+    and never be negative
+    Args: (child_id, applied)
+    Returns: list of problem descriptions"""
+
+    points = db.session.execute(db.select(Child.points)
+        .where(Child.id == child_id)).scalar()
+    entries = db.session.execute(db.select(PointsEntry.delta, PointsEntry.balance)
+        .where(PointsEntry.child_id == child_id).order_by(PointsEntry.id)).all()
+
+    problems = []
+    if points != sum(applied):
+        problems.append(f'{points} points, committed changes total {sum(applied)}')
+    if len(entries) != len(applied):
+        problems.append(f'{len(entries)} ledger entries for {len(applied)} changes')
+    balance = 0
+    for number, (delta, entry_balance) in enumerate(entries):
+        balance += delta
+        if entry_balance != balance or entry_balance < 0:
+            problems.append(f'ledger entry {number} has balance {entry_balance}, '
+                f'expected {balance}')
+            break
+    return problems
+
+@click.command('stress-points')
+@click.option('--workers', default=8, help='Threads changing points at once, '
+    'half earning and half spending.')
+@click.option('--rounds', default=50, help='Changes made by each thread.')
+@click.option('--cost', default=3, help='Points spent per purchase.')
+@click.option('--keep', is_flag=True, help='Keep the stress test family afterwards.')
+@with_appcontext
+def stress_points_command(workers, rounds, cost, keep):
+    """Check the points ledger under concurrent add_points() and
+    purchase_reward() calls on one child"""
+
+    from .helpers import remove_family
+
+    app = current_app._get_current_object()
+    remove_family(db.session.execute(db.select(Parent.id)
+        .where(Parent.username == f'{STRESS_PREFIX}@example.com')).scalars().all())
+    db.session.commit()
+    parent_id, child_id, reward_id = stress_family(cost)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(earn_points, app, child_id, rounds)
+                if number % 2 == 0
+                else executor.submit(spend_points, app, child_id, reward_id, rounds)
+            for number in range(workers)]
+        applied = [delta for future in futures for delta in future.result()]
+    db.session.expire_all()
+
+    problems = ledger_problems(child_id, applied)
+    earned = sum(delta for delta in applied if delta > 0)
+    click.echo(f'{len(applied)} of {workers * rounds} changes committed: '
+        f'{earned} points earned, {earned - sum(applied)} spent')
+    if not keep:
+        remove_family([parent_id])
+        db.session.commit()
+    for problem in problems:
+        click.echo(problem)
+    if problems:
+        raise click.ClickException('Points ledger is inconsistent')
+    click.echo('Points and ledger are consistent')
@@ -0,0 +1,165 @@
+from hmac import compare_digest
+from threading import Lock
+from time import perf_counter
+from flask import abort, current_app, jsonify, request
+from sqlalchemy import exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+# Gunicorn worker classes serving many requests per process with greenlets
+GREEN_WORKERS = ('gevent', 'eventlet')
+
+class PoolStats:
+    """Connection checkouts and time spent waiting for them in one process"""
+
+    __slots__ = ('checkouts', 'wait_time', 'max_wait', 'timeouts', '_lock')
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self._lock = Lock()
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+                self.wait_time += wait
+                self.max_wait = max(self.max_wait, wait)
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout waits for a connection,
+    including opening a new one"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.record(perf_counter() - start, timed_out=True)
+            raise
+        self.stats.record(perf_counter() - start)
+        return connection
+
+def worker_concurrency(config):
+    """Requests a single web worker process can serve at once
+    Args: (config)"""
+
+    if config['WEB_WORKER_CLASS'] in GREEN_WORKERS:
+        return config['WEB_WORKER_CONNECTIONS']
+    return config['WEB_THREADS']
+
+def pool_size(config):
+    """Database connections kept by each worker process. Green workers
+    share a smaller pool, as requests spend most of their time outside the
+    database; thread and sync workers get a connection per thread.
+    Args: (config)"""
+
+    if config['DB_POOL_SIZE']:
+        return config['DB_POOL_SIZE']
+    concurrency = worker_concurrency(config)
+    if config['WEB_WORKER_CLASS'] in GREEN_WORKERS:
+        return min(concurrency, config['DB_GREEN_POOL_LIMIT'])
+    return concurrency
+
+def total_connections(config):
+    """Most database connections the deployment can open: every web
+    worker's pool plus its event listener, across all machines, plus the
+    connections reserved for the scheduler and release commands
+    Args: (config)"""
+
+    per_worker = config['DB_POOL_SIZE'] + config['DB_MAX_OVERFLOW'] + 1
+    return (config['WEB_MACHINES'] * config['WEB_WORKERS'] * per_worker
+        + config['DB_RESERVED_CONNECTIONS'])
+
+def engine_options(config):
+    """Engine options for the configured pool. Connections are replaced
+    after DB_POOL_RECYCLE seconds and dead ones are found by TCP keepalives,
+    rather than pinging the server on every checkout. Behind PgBouncer in
+    transaction mode, PgBouncer does the pooling, so none is kept here.
+    Args: (config)"""
+
+    # psycopg2 keepalives notice dropped connections between requests
+    options = {'connect_args': {'keepalives': 1, 'keepalives_idle': 30,
+        'keepalives_interval': 10, 'keepalives_count': 3}}
+    if config['DB_PGBOUNCER']:
+        options['poolclass'] = NullPool
+        return options
+
+    options.update(poolclass=TimedQueuePool, pool_size=config['DB_POOL_SIZE'],
+        max_overflow=config['DB_MAX_OVERFLOW'], pool_timeout=config['DB_POOL_TIMEOUT'],
+        pool_recycle=config['DB_POOL_RECYCLE'],
+        # Idle connections beyond what traffic needs reach pool_recycle
+        # and are closed, instead of being kept alive in rotation
+        pool_use_lifo=True)
+    return options
+
+def pool_status(engine):
+    """Current state of engine's pool and this process's checkout totals
+    Args: (engine)"""
+
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {'pool': type(pool).__name__}
+
+    status = {'pool': type(pool).__name__, 'size': pool.size(),
+        'checked_out': pool.checkedout(), 'checked_in': pool.checkedin(),
+        'overflow': pool.overflow()}
+    stats = getattr(pool, 'stats', None)
+    if stats is not None:
+        status.update(checkouts=stats.checkouts, timeouts=stats.timeouts,
+            wait_ms_total=round(stats.wait_time * 1000, 1),
+            wait_ms_max=round(stats.max_wait * 1000, 1))
+    return status
+
+def pool_stats_view():
+    """Pool status as JSON for monitoring, for requests with the
+    METRICS_TOKEN bearer token"""
+
+    from .sql_models import db
+
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    # compare_digest only accepts ASCII str, and headers can hold any text
+    if not compare_digest(token.encode(), current_app.config['METRICS_TOKEN'].encode()):
+        abort(404)
+    return jsonify(pool_status(db.engine))
+
+def init_pool(app):
+    """Size and tune the connection pool from the web worker model, and
+    refuse to start if the deployment could open more connections than the
+    database allows. Pool options only apply to PostgreSQL, and options
+    already in SQLALCHEMY_ENGINE_OPTIONS are kept. Pool stats are served
+    at /internal/pool when METRICS_TOKEN is set.
+    Args: (app)"""
+
+    config = app.config
+    if config['METRICS_TOKEN']:
+        app.add_url_rule('/internal/pool', 'pool_stats', pool_stats_view)
+
+    if not config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+        return
+
+    config['DB_POOL_SIZE'] = pool_size(config)
+    options = config['SQLALCHEMY_ENGINE_OPTIONS']
+    for key, value in engine_options(config).items():
+        options.setdefault(key, value)
+
+    if config['DB_PGBOUNCER']:
+        app.logger.info('Database pool: none, connections pooled by PgBouncer')
+        return
+
+    total = total_connections(config)
+    if total > config['DB_MAX_CONNECTIONS']:
+        raise RuntimeError(f'{total} database connections needed by '
+            f'{config["WEB_MACHINES"]} machines with {config["WEB_WORKERS"]} workers '
+            f'and pool size {config["DB_POOL_SIZE"]}, database allows '
+            f'{config["DB_MAX_CONNECTIONS"]}')
+    app.logger.info('Database pool: %d connections per worker, %d of %d in total',
+        config['DB_POOL_SIZE'] + config['DB_MAX_OVERFLOW'], total,
+        config['DB_MAX_CONNECTIONS'])
@@ -0,0 +1,205 @@
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+import click
+from flask import g, request, has_request_context, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, text
+from sqlalchemy.engine import Engine
+
+from .sql_models import (db, Child, Chore, AssignedChore, Reward,
+    ParentNotification, ChildNotification)
+
+class QueryBudgetExceeded(Exception):
+    """Raised in testing when a request issues more statements than its budget"""
+
+class QueryStats:
+    """Statement count and total database time for a single request"""
+
+    __slots__ = ('count', 'time')
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    @property
+    def time_ms(self):
+        return self.time * 1000
+
+def current_stats():
+    """Return QueryStats for the active request, or None if not collecting"""
+
+    if has_request_context():
+        return g.get('query_stats')
+    return None
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Record statement start time on the connection"""
+
+    if current_stats() is not None:
+        conn.info.setdefault('query_start_time', []).append(perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Add finished statement to the request's QueryStats"""
+
+    stats = current_stats()
+    start_times = conn.info.get('query_start_time')
+    if stats is None or not start_times:
+        return
+    stats.count += 1
+    stats.time += perf_counter() - start_times.pop()
+
+# (engine, QueryStats) of the statement budgeted functions running in this context
+_budget_stats = ContextVar('budget_stats', default=())
+
+def _count_budget_statement(conn, cursor, statement, parameters, context, executemany):
+    """Add statement to every running budgeted function's QueryStats"""
+
+    for engine, stats in _budget_stats.get():
+        # Only statements of the app's engine count. Actions publish
+        # events, which may use it too, after returning (see services.py)
+        if conn.engine is engine:
+            stats.count += 1
+
+def statement_budget(budget):
+    """Decorate a function with the most SQL statements it may issue.
+    Functions over budget raise QueryBudgetExceeded in testing and log a
+    warning otherwise.
+    Args: (budget)"""
+
+    def decorator(function):
+        @wraps(function)
+        def budgeted(*args, **kwargs):
+            if not event.contains(Engine, 'after_cursor_execute',
+                    _count_budget_statement):
+                event.listen(Engine, 'after_cursor_execute', _count_budget_statement)
+            stats = QueryStats()
+            token = _budget_stats.set(_budget_stats.get() + ((db.engine, stats),))
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                _budget_stats.reset(token)
+            if stats.count > budget:
+                message = (f'{function.__name__} issued {stats.count} statements, '
+                    f'budget is {budget}')
+                if current_app.testing:
+                    raise QueryBudgetExceeded(message)
+                current_app.logger.warning(message)
+            return result
+        budgeted.statement_budget = budget
+        return budgeted
+    return decorator
+
+def query_budget(app, endpoint):
+    """Return the statement budget for an endpoint, or None if unlimited
+    Args: (app, endpoint)"""
+
+    budgets = app.config['QUERY_BUDGETS']
+    if endpoint in budgets:
+        return budgets[endpoint]
+    return app.config['QUERY_BUDGET']
+
+def init_query_stats(app):
+    """Count SQL statements and database time for every request.
+    Totals are logged at debug level and returned in the X-Query-Count and
+    X-Query-Time headers. Requests over QUERY_BUDGET (or the endpoint's entry
+    in QUERY_BUDGETS) raise QueryBudgetExceeded in testing and log a warning
+    otherwise.
+    Args: (app)"""
+
+    app.config.setdefault('QUERY_BUDGET', None)
+    app.config.setdefault('QUERY_BUDGETS', {})
+
+    # Listeners are attached to every engine once per process
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = current_stats()
+        if stats is None:
+            return response
+
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers['X-Query-Time'] = f'{stats.time_ms:.1f}'
+        app.logger.debug('%s %s: %d queries in %.1f ms', request.method,
+            request.path, stats.count, stats.time_ms)
+
+        budget = query_budget(app, request.endpoint)
+        if budget is not None and stats.count > budget:
+            message = (f'{request.endpoint} issued {stats.count} queries, '
+                f'budget is {budget}')
+            if app.testing:
+                raise QueryBudgetExceeded(message)
+            app.logger.warning(message)
+        return response
+
+def hot_queries():
+    """Statements behind the busiest pages, with a placeholder id, whose
+    plans must use an index. Returns list of (name, statement)"""
+
+    return [
+        ('parent dashboard children', db.select(Child.id, func.count(AssignedChore.id))
+            .outerjoin(AssignedChore, AssignedChore.user_id == Child.id)
+            .where(Child.parent_id == 1).group_by(Child.id)),
+        ('parent notifications', db.select(ParentNotification)
+            .where(ParentNotification.parent_id == 1).order_by(ParentNotification.id)),
+        ('child notifications', db.select(ChildNotification)
+            .where(ChildNotification.child_id == 1).order_by(ChildNotification.id)),
+        ('assigned chore list', db.select(AssignedChore.id, Chore.name)
+            .join(Chore, Chore.id == AssignedChore.chore_id)
+            .where(AssignedChore.user_id.in_([1, 2])).order_by(AssignedChore.id)),
+        ('duplicate assignment check', db.select(AssignedChore)
+            .where(AssignedChore.user_id == 1, AssignedChore.chore_id == 1)),
+        ('parent chores', db.select(Chore).where(Chore.parent_id == 1).order_by(Chore.name)),
+        ('parent rewards', db.select(Reward).where(Reward.parent_id == 1)),
+        ('child notifications for parent', db.select(ParentNotification)
+            .where(ParentNotification.child_id == 1)),
+    ]
+
+def explain(statement):
+    """Return query plan lines for statement on the current database.
+    Sequential scans are disabled on PostgreSQL so small tables still show
+    whether an index can be used.
+    Args: (statement)"""
+
+    dialect = db.engine.dialect
+    sql = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    with db.engine.connect() as connection:
+        if dialect.name == 'postgresql':
+            connection.execute(text('SET LOCAL enable_seqscan = off'))
+            plan = list(connection.execute(text(f'EXPLAIN {sql}')).scalars())
+        else:
+            plan = [row[-1] for row in connection.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+        connection.rollback()
+    return plan
+
+def uses_index(plan):
+    """Returns true if no table in the plan is read with a full scan
+    Args: (plan)"""
+
+    return not any('Seq Scan' in line or line.strip().startswith('SCAN ')
+        for line in plan)
+
+@click.command('explain-queries')
+@with_appcontext
+def explain_queries_command():
+    """Check that hot queries are planned with index lookups"""
+
+    missing = []
+    for name, statement in hot_queries():
+        plan = explain(statement)
+        if uses_index(plan):
+            click.echo(f'index: {name}')
+        else:
+            missing.append(name)
+            click.echo(f'NO INDEX: {name}')
+            for line in plan:
+                click.echo(f'    {line}')
+    if missing:
+        raise click.ClickException(f'{len(missing)} queries without an index')
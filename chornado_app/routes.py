@@ -1,10 +1,15 @@
-from flask import redirect, render_template, request, url_for, Blueprint, flash
+import json
+from time import monotonic
+from flask import (redirect, render_template, request, url_for, Blueprint, flash,
+    current_app, Response)
 from flask_login import current_user, login_required, logout_user
-from werkzeug.security import generate_password_hash
 
 from .forms import (DeleteUserForm, ChildResetPasswordForm, LoginForm)
-from .sql_models import (db, Parent, Child, ParentNotification)
-from .helpers import (db_commit, flash_errors)
+from .sql_models import (Parent, Child)
+from .passwords import hash_password
+from .events import user_channel
+from .helpers import (db_commit, flash_errors, invalidate_user, remove_child,
+    remove_family)
 
 routes_bp = Blueprint('routes', __name__)
 
@@ -32,13 +37,11 @@ def delete_child(user_id):
     form = DeleteUserForm()
 
     if request.method == 'POST' and form.validate_on_submit():
-        # Identify notifications linked to child account for deletion
-        notifications = ParentNotification.query.filter_by(child_id=user.id).all()
-        for notification in notifications:
-            db.session.delete(notification)
-        flash(f'{user.first_name} has been deleted.', 'success')
-        db.session.delete(user)
-        db_commit()
+        # Only deletes the child if they belong to current user
+        deleted = remove_child(user_id, current_user.id)
+        if deleted is not None and db_commit():
+            flash(f'{deleted.first_name} has been deleted.', 'success')
+            invalidate_user(deleted.username)
         return redirect(url_for('parent.children'))
 
     if user is not None and user in current_user.children:
@@ -55,11 +58,12 @@ def delete_parent(user_id):
     user = Parent.query.get(user_id)
     form = DeleteUserForm()
 
-    if request.method == 'POST' and form.validate_on_submit():
+    if request.method == 'POST' and user == current_user and form.validate_on_submit():
         flash(f'{user.first_name} has been deleted.', 'success')
         logout_user()
-        db.session.delete(user)
+        usernames = remove_family([user.id])
         db_commit()
+        invalidate_user(*usernames)
         return redirect(url_for('routes.index'))
 
     if user is not None and user == current_user:
@@ -76,18 +80,48 @@ def pass_reset(user_id):
     user = Child.query.get(user_id)
     form = ChildResetPasswordForm()
 
+    # Only resets the password of current user's own children
+    if (current_user.type != 'parent' or user is None
+            or user.parent_id != current_user.id):
+        return redirect(url_for('parent.children'))
+
     if request.method == 'POST' and form.validate_on_submit():
         password = form.new_password.data
-        pw_hash = generate_password_hash(password, method='pbkdf2:sha256', salt_length=8)
-        user.password_hash = pw_hash
+        user.password_hash = hash_password(password)
         db_commit()
+        invalidate_user(user.username)
         return redirect(url_for('parent.children'))
 
-    if user is not None and user.parent_id == current_user.id:
-        flash_errors(form)
-        return render_template('pass_reset.html', template_form=form, user=user)
+    flash_errors(form)
+    return render_template('pass_reset.html', template_form=form, user=user)
 
-    return redirect(url_for('parent.children'))
+@routes_bp.route('/events')
+@login_required
+def events():
+    """Server-sent event stream of new notifications for current user.
+    Streams end after EVENTS_STREAM_TIMEOUT seconds and the browser
+    reconnects, so workers are not held indefinitely"""
+
+    channel = user_channel(current_user.type, current_user.id)
+    subscription = current_app.extensions['events'].subscribe(channel)
+    timeout = current_app.config['EVENTS_STREAM_TIMEOUT']
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            deadline = monotonic() + timeout
+            while monotonic() < deadline:
+                event = subscription.get(timeout=min(15, timeout))
+                if event is None:
+                    # Comment line keeps proxies from closing idle stream
+                    yield ': keepalive\n\n'
+                else:
+                    yield f'data: {json.dumps(event)}\n\n'
+        finally:
+            subscription.close()
+
+    return Response(stream(), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # Route used for intiializing db if required
 # @routes_bp.route('/init_db')
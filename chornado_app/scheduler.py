@@ -0,0 +1,127 @@
+from collections import namedtuple
+from datetime import date
+from time import sleep
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import literal, or_
+
+from .sql_models import db, AssignedChore, Child, Chore, ChoreSchedule, Parent
+from .helpers import db_commit, touch_family
+
+# Weekday names in bitmask order, Monday = bit 0
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday',
+    'Sunday']
+EVERY_DAY = 0b1111111
+
+# Row used by templates to display chore schedules
+ScheduleRow = namedtuple('ScheduleRow', ['id', 'chore', 'child', 'days'])
+
+def weekday_mask(days):
+    """Convert list of weekday numbers (Monday = 0) to a bitmask
+    Args: (days)"""
+
+    mask = 0
+    for day in days:
+        mask |= 1 << day
+    return mask
+
+def describe_weekdays(mask):
+    """Readable list of days in a weekday bitmask
+    Args: (mask)"""
+
+    if mask == EVERY_DAY:
+        return 'Every day'
+    return ', '.join(name for day, name in enumerate(WEEKDAYS) if mask & (1 << day))
+
+def schedule_chore(chore_id, user_id, weekdays):
+    """Create or update recurring schedule for chore and child
+    Args: (chore_id, user_id, weekdays)"""
+
+    schedule = ChoreSchedule.query.filter_by(chore_id=chore_id, user_id=user_id).first()
+    if schedule is None:
+        schedule = ChoreSchedule(chore_id=chore_id, user_id=user_id)
+        db.session.add(schedule)
+    schedule.weekdays = weekdays
+    return schedule
+
+def remove_schedule(schedule_id, parent_id):
+    """Remove recurring schedule if it belongs to parent's chores
+    Args: (schedule_id, parent_id)"""
+
+    parent_chores = db.select(Chore.id).where(Chore.parent_id == parent_id)
+    db.session.execute(db.delete(ChoreSchedule).where(ChoreSchedule.id == schedule_id,
+        ChoreSchedule.chore_id.in_(parent_chores)))
+    touch_family(parent_id)
+
+def load_schedules(parent_id):
+    """Load parent's chore schedules with chore and child names
+    Args: (parent_id)
+    Returns: list of ScheduleRow"""
+
+    rows = db.session.execute(
+        db.select(ChoreSchedule.id, Chore.name, Child.first_name, ChoreSchedule.weekdays)
+        .join(Chore, Chore.id == ChoreSchedule.chore_id)
+        .join(Child, Child.id == ChoreSchedule.user_id)
+        .where(Chore.parent_id == parent_id)
+        .order_by(Chore.name, Child.first_name))
+    return [ScheduleRow(row.id, row.name, row.first_name, describe_weekdays(row.weekdays))
+        for row in rows]
+
+def generate_scheduled_chores(today):
+    """Assign every chore scheduled for today, for all families, with one
+    INSERT ... SELECT. Schedules are claimed by setting last_run in the same
+    statement, so running twice in a day, or from two workers at once,
+    assigns each chore only once. Chores a child still has assigned from an
+    earlier day are not assigned again.
+    Args: (today)
+    Returns: number of chores assigned"""
+
+    # Core tables, as ORM statements can't be used inside a CTE
+    schedule = ChoreSchedule.__table__
+    assigned = AssignedChore.__table__
+
+    claimed = (db.update(schedule)
+        .where(schedule.c.weekdays.op('&')(1 << today.weekday()) != 0,
+            or_(schedule.c.last_run.is_(None), schedule.c.last_run < today))
+        .values(last_run=today)
+        .returning(schedule.c.chore_id, schedule.c.user_id)
+        .cte('claimed'))
+
+    already_assigned = db.select(assigned.c.id).where(
+        assigned.c.chore_id == claimed.c.chore_id,
+        assigned.c.user_id == claimed.c.user_id)
+
+    result = db.session.execute(db.insert(assigned)
+        .add_cte(claimed)
+        .from_select(['state', 'chore_id', 'user_id'],
+            db.select(literal('Active'), claimed.c.chore_id, claimed.c.user_id)
+            .where(~already_assigned.exists())))
+
+    if result.rowcount:
+        # Families with schedules run today now have new chores
+        families = (db.select(Child.parent_id)
+            .join(ChoreSchedule, ChoreSchedule.user_id == Child.id)
+            .where(ChoreSchedule.last_run == today))
+        db.session.execute(db.update(Parent).where(Parent.id.in_(families))
+            .values(data_version=Parent.data_version + 1)
+            .execution_options(synchronize_session=False))
+    return result.rowcount
+
+@click.command('run-scheduler')
+@click.option('--date', 'run_date', type=click.DateTime(['%Y-%m-%d']),
+    help='Date to generate chores for. Defaults to today.')
+@click.option('--interval', type=int, default=0,
+    help='Keep running, checking for due chores every INTERVAL seconds.')
+@with_appcontext
+def run_scheduler_command(run_date, interval):
+    """Assign recurring chores that are due"""
+
+    while True:
+        today = run_date.date() if run_date else date.today()
+        count = generate_scheduled_chores(today)
+        if db_commit():
+            click.echo(f'{today}: assigned {count} scheduled chores')
+        if not interval:
+            break
+        db.session.remove()
+        sleep(interval)
@@ -0,0 +1,400 @@
+from collections import namedtuple
+from contextvars import ContextVar
+from functools import wraps
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func
+from sqlalchemy.dialects import postgresql, sqlite
+
+from .sql_models import (db, Account, Parent, Child, Chore, AssignedChore, Reward,
+    ParentNotification, ChildNotification, ActivityLog)
+from .events import publish_notification
+from .points import add_points, change_points
+from .query_stats import QueryBudgetExceeded, statement_budget
+from .helpers import db_commit, touch_family, invalidate_user, remove_family
+
+# Chore and reward actions. Each runs as one transaction of a fixed number
+# of statements, listed in its docstring and enforced by statement_budget.
+# Ownership is checked in the WHERE clause of the first statement, which
+# returns everything else the action needs, so nothing is loaded first.
+# The data version UPDATE made by db_commit() is included in each count.
+# Notifications are published after the budget is checked, as the
+# PostgreSQL event broker publishes through the same engine.
+
+# Core tables, as ORM UPDATE and DELETE can't return subqueries
+assigned = AssignedChore.__table__
+child_table = Child.__table__
+chore_table = Chore.__table__
+reward_table = Reward.__table__
+
+# INSERT constructs with ON CONFLICT support, by dialect
+DIALECT_INSERTS = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+# Child and chore or reward an action was applied to
+ActionResult = namedtuple('ActionResult', ['child_id', 'username', 'first_name',
+    'item', 'points'])
+
+class RewardNotFound(Exception):
+    """Raised when a child tries to buy a reward their parent doesn't have"""
+
+# Notifications queued by the running action
+_pending_notifications = ContextVar('pending_notifications')
+
+# Username prefix of the family created by check-budgets
+CHECK_PREFIX = 'check-budgets'
+
+def publishes(action):
+    """Publish the notifications an action queues with notify() once it
+    has returned, outside its statement budget"""
+
+    @wraps(action)
+    def publishing(*args, **kwargs):
+        pending = []
+        token = _pending_notifications.set(pending)
+        try:
+            result = action(*args, **kwargs)
+        finally:
+            _pending_notifications.reset(token)
+        for user_type, user_id, message in pending:
+            publish_notification(user_type, user_id, message)
+        return result
+    return publishing
+
+def notify(user_type, user_id, message):
+    """Queue a notification message for a user's open pages, sent when the
+    running action returns
+    Args: (user_type, user_id, message)"""
+
+    _pending_notifications.get().append((user_type, user_id, message))
+
+def child_value(column, child_id):
+    """Scalar subquery of a child column, for use in RETURNING
+    Args: (column, child_id)"""
+
+    return db.select(column).where(child_table.c.id == child_id).scalar_subquery()
+
+def chore_value(column, chore_id):
+    """Scalar subquery of a chore column, for use in RETURNING
+    Args: (column, chore_id)"""
+
+    return db.select(column).where(chore_table.c.id == chore_id).scalar_subquery()
+
+def family_children(parent_id):
+    """Ids of parent's children, for ownership checks
+    Args: (parent_id)"""
+
+    return db.select(child_table.c.id).where(child_table.c.parent_id == parent_id)
+
+def upsert_chore_notification(model, owner, values):
+    """Insert a chore notification, or refresh the recipient's existing one
+    of the same type for the same assigned chore, in one statement
+    Args: (model, owner, values)
+        owner: parent_id or child_id"""
+
+    insert = DIALECT_INSERTS[db.engine.dialect.name](model.__table__).values(**values)
+    db.session.execute(insert.on_conflict_do_update(
+        index_elements=['chore_id', owner, 'type'],
+        set_={'message': insert.excluded.message, 'created_at': func.now()}))
+
+def finish(child_id, parent_id, username, first_name, item, points=None):
+    """Commit an action, invalidating the child's cached user if their
+    points changed
+    Args: (child_id, parent_id, username, first_name, item, points)
+    Returns: ActionResult, or None if the commit failed"""
+
+    touch_family(parent_id)
+    if not db_commit():
+        return None
+    if points is not None:
+        invalidate_user(username)
+    return ActionResult(child_id, username, first_name, item, points)
+
+@publishes
+@statement_budget(5)
+def complete_chore(chore_id, child):
+    """Mark child's assigned chore complete, clear any request to try it
+    again, and notify their parent.
+    Statements: UPDATE ... RETURNING, DELETE of child notifications,
+    notification upsert, activity INSERT, data version UPDATE
+    Args: (chore_id, child)
+    Returns: ActionResult, or None if the chore isn't assigned to child"""
+
+    name = db.session.execute(db.update(assigned)
+        .where(assigned.c.id == chore_id, assigned.c.user_id == child.id)
+        .values(state='Complete')
+        .returning(chore_value(chore_table.c.name, assigned.c.chore_id))).scalar()
+    if name is None:
+        db.session.rollback()
+        return None
+
+    db.session.execute(db.delete(ChildNotification)
+        .where(ChildNotification.chore_id == chore_id)
+        .execution_options(synchronize_session=False))
+    message = f'{child.first_name} has completed {name}.'
+    upsert_chore_notification(ParentNotification, 'parent_id', {'type': 'chore',
+        'message': message, 'parent_id': child.parent_id, 'child_id': child.id,
+        'chore_id': chore_id})
+    db.session.add(ActivityLog(parent_id=child.parent_id, child_id=child.id,
+        child_name=child.first_name, action='completed', item=name))
+    # Committing expires child, so its values are read first
+    parent_id = child.parent_id
+    result = finish(child.id, parent_id, child.username, child.first_name, name)
+    if result is not None:
+        notify('parent', parent_id, message)
+    return result
+
+@statement_budget(5)
+def approve_chore(chore_id, parent_id):
+    """Remove a completed chore and give its points to the child. The
+    chore's notifications are removed by ON DELETE CASCADE.
+    Statements: DELETE ... RETURNING, points UPDATE, points ledger INSERT,
+    activity INSERT, data version UPDATE
+    Args: (chore_id, parent_id)
+    Returns: ActionResult, or None if the chore isn't assigned to parent's child"""
+
+    row = db.session.execute(db.delete(assigned)
+        .where(assigned.c.id == chore_id,
+            assigned.c.user_id.in_(family_children(parent_id)))
+        .returning(assigned.c.user_id,
+            chore_value(chore_table.c.name, assigned.c.chore_id).label('name'),
+            chore_value(chore_table.c.value, assigned.c.chore_id).label('value'),
+            child_value(child_table.c.username, assigned.c.user_id).label('username'),
+            child_value(child_table.c.first_name, assigned.c.user_id)
+                .label('first_name'))).first()
+    if row is None:
+        db.session.rollback()
+        return None
+
+    add_points(row.user_id, row.value, f'Completed {row.name}')
+    db.session.add(ActivityLog(parent_id=parent_id, child_id=row.user_id,
+        child_name=row.first_name, action='approved', item=row.name, points=row.value))
+    return finish(row.user_id, parent_id, row.username, row.first_name, row.name,
+        row.value)
+
+@publishes
+@statement_budget(5)
+def reject_chore(chore_id, parent_id):
+    """Send a completed chore back to the child, replacing the parent's
+    notification with one asking the child to try again.
+    Statements: UPDATE ... RETURNING, DELETE of parent notifications,
+    notification upsert, activity INSERT, data version UPDATE
+    Args: (chore_id, parent_id)
+    Returns: ActionResult, or None if the chore isn't assigned to parent's child"""
+
+    row = db.session.execute(db.update(assigned)
+        .where(assigned.c.id == chore_id,
+            assigned.c.user_id.in_(family_children(parent_id)))
+        .values(state='Rejected')
+        .returning(assigned.c.user_id,
+            chore_value(chore_table.c.name, assigned.c.chore_id).label('name'),
+            child_value(child_table.c.username, assigned.c.user_id).label('username'),
+            child_value(child_table.c.first_name, assigned.c.user_id)
+                .label('first_name'))).first()
+    if row is None:
+        db.session.rollback()
+        return None
+
+    db.session.execute(db.delete(ParentNotification)
+        .where(ParentNotification.chore_id == chore_id)
+        .execution_options(synchronize_session=False))
+    message = f'Your parent says that {row.name} needs another try.'
+    upsert_chore_notification(ChildNotification, 'child_id', {'type': 'chore',
+        'message': message, 'child_id': row.user_id, 'chore_id': chore_id})
+    db.session.add(ActivityLog(parent_id=parent_id, child_id=row.user_id,
+        child_name=row.first_name, action='rejected', item=row.name))
+    result = finish(row.user_id, parent_id, row.username, row.first_name, row.name)
+    if result is not None:
+        notify('child', row.user_id, message)
+    return result
+
+@statement_budget(2)
+def remove_assigned_chore(chore_id, parent_id):
+    """Unassign a chore from parent's child.
+    Statements: DELETE ... RETURNING, data version UPDATE
+    Args: (chore_id, parent_id)
+    Returns: ActionResult, or None if the chore isn't assigned to parent's child"""
+
+    row = db.session.execute(db.delete(assigned)
+        .where(assigned.c.id == chore_id,
+            assigned.c.user_id.in_(family_children(parent_id)))
+        .returning(assigned.c.user_id,
+            chore_value(chore_table.c.name, assigned.c.chore_id).label('name'),
+            child_value(child_table.c.username, assigned.c.user_id).label('username'),
+            child_value(child_table.c.first_name, assigned.c.user_id)
+                .label('first_name'))).first()
+    if row is None:
+        db.session.rollback()
+        return None
+    return finish(row.user_id, parent_id, row.username, row.first_name, row.name)
+
+@publishes
+@statement_budget(6)
+def purchase_reward(child, reward_id):
+    """Spend child's points on one of their parent's rewards and notify the
+    parent. Points are only taken if the child has enough.
+    Statements: reward SELECT, points UPDATE, points ledger INSERT,
+    notification INSERT, activity INSERT, data version UPDATE
+    Args: (child, reward_id)
+    Returns: ActionResult, or None if the child doesn't have enough points
+    Raises: RewardNotFound if the reward isn't one of their parent's"""
+
+    reward = db.session.execute(db.select(reward_table.c.name, reward_table.c.cost)
+        .where(reward_table.c.id == reward_id,
+            reward_table.c.parent_id == child.parent_id)).first()
+    if reward is None:
+        db.session.rollback()
+        raise RewardNotFound(reward_id)
+    if change_points(child, -reward.cost, f'Purchased {reward.name}',
+            require_balance=True) is None:
+        db.session.rollback()
+        return None
+
+    message = f'{child.first_name} has purchased {reward.name}'
+    db.session.add(ParentNotification(type='reward', message=message,
+        parent_id=child.parent_id, child_id=child.id, reward_id=reward_id))
+    db.session.add(ActivityLog(parent_id=child.parent_id, child_id=child.id,
+        child_name=child.first_name, action='purchased', item=reward.name,
+        points=-reward.cost))
+    parent_id = child.parent_id
+    result = finish(child.id, parent_id, child.username, child.first_name,
+        reward.name, -reward.cost)
+    if result is not None:
+        notify('parent', parent_id, message)
+    return result
+
+@publishes
+@statement_budget(4)
+def deliver_reward(notification_id, parent_id):
+    """Mark a purchased reward as given, replacing the parent's notification
+    with one for the child.
+    Statements: DELETE ... RETURNING, notification INSERT, activity INSERT,
+    data version UPDATE
+    Args: (notification_id, parent_id)
+    Returns: ActionResult, or None if parent has no such reward notification"""
+
+    notifications = ParentNotification.__table__
+    row = db.session.execute(db.delete(notifications)
+        .where(notifications.c.id == notification_id,
+            notifications.c.parent_id == parent_id, notifications.c.type == 'reward')
+        .returning(notifications.c.child_id, notifications.c.reward_id,
+            db.select(reward_table.c.name)
+                .where(reward_table.c.id == notifications.c.reward_id)
+                .scalar_subquery().label('name'),
+            child_value(child_table.c.username, notifications.c.child_id)
+                .label('username'),
+            child_value(child_table.c.first_name, notifications.c.child_id)
+                .label('first_name'))).first()
+    if row is None:
+        db.session.rollback()
+        return None
+
+    message = f'You have been given {row.name}!'
+    db.session.add(ChildNotification(type='reward', message=message,
+        child_id=row.child_id, reward_id=row.reward_id))
+    db.session.add(ActivityLog(parent_id=parent_id, child_id=row.child_id,
+        child_name=row.first_name, action='delivered', item=row.name))
+    result = finish(row.child_id, parent_id, row.username, row.first_name, row.name)
+    if result is not None:
+        notify('child', row.child_id, message)
+    return result
+
+@statement_budget(2)
+def acknowledge_notification(notification_id, child):
+    """Remove one of child's notifications.
+    Statements: DELETE, data version UPDATE
+    Args: (notification_id, child)
+    Returns: true if the notification was removed"""
+
+    deleted = db.session.execute(db.delete(ChildNotification)
+        .where(ChildNotification.id == notification_id,
+            ChildNotification.child_id == child.id)
+        .execution_options(synchronize_session=False)).rowcount
+    if not deleted:
+        db.session.rollback()
+        return False
+    touch_family(child.parent_id)
+    return db_commit()
+
+def budget_family():
+    """Add a parent and child with two assigned chores and a reward, for
+    check-budgets. No one can log in as them
+    Returns: (parent_id, child_id, [assigned chore ids], reward_id)"""
+
+    parent = Parent(username=f'{CHECK_PREFIX}@example.com', first_name='Budget',
+        last_name='Check', password_hash='!')
+    child = Child(username=f'{CHECK_PREFIX}-child', first_name='Budget',
+        password_hash='!', parent=parent, points=0)
+    chore = Chore(name='Budget chore', value=5, parent=parent)
+    reward = Reward(name='Budget reward', cost=3, parent=parent)
+    db.session.add_all([parent, child, chore, reward,
+        Account(username=parent.username, type='parent', parent=parent),
+        Account(username=child.username, type='child', child=child)])
+    db.session.flush()
+    assigned_chores = [AssignedChore(state='Active', chore_id=chore.id, user_id=child.id)
+        for _ in range(2)]
+    db.session.add_all(assigned_chores)
+    db.session.commit()
+    return parent.id, child.id, [row.id for row in assigned_chores], reward.id
+
+def budget_steps(parent_id, child_id, chore_ids, reward_id):
+    """Yield (action, call) for every action, in an order where each one
+    has something to act on
+    Args: (parent_id, child_id, chore_ids, reward_id)"""
+
+    def child():
+        return db.session.get(Child, child_id)
+
+    def notification(model, owner):
+        return db.session.execute(db.select(model.id).where(owner == (
+            parent_id if model is ParentNotification else child_id))
+            .order_by(model.id.desc())).scalar()
+
+    chore_id, other_id = chore_ids
+    yield complete_chore, lambda: complete_chore(chore_id, child())
+    yield reject_chore, lambda: reject_chore(chore_id, parent_id)
+    yield complete_chore, lambda: complete_chore(chore_id, child())
+    yield approve_chore, lambda: approve_chore(chore_id, parent_id)
+    yield remove_assigned_chore, lambda: remove_assigned_chore(other_id, parent_id)
+    yield purchase_reward, lambda: purchase_reward(child(), reward_id)
+    yield deliver_reward, lambda: deliver_reward(notification(ParentNotification,
+        ParentNotification.parent_id), parent_id)
+    yield acknowledge_notification, lambda: acknowledge_notification(
+        notification(ChildNotification, ChildNotification.child_id), child())
+
+@click.command('check-budgets')
+@with_appcontext
+def check_budgets_command():
+    """Run every chore and reward action on a temporary family and check
+    that each stays within its statement budget"""
+
+    app = current_app._get_current_object()
+    remove_family(db.session.execute(db.select(Parent.id)
+        .where(Parent.username == f'{CHECK_PREFIX}@example.com')).scalars().all())
+    db.session.commit()
+    parent_id, *family = budget_family()
+
+    failed = []
+    # statement_budget raises instead of logging while testing
+    testing, app.testing = app.testing, True
+    try:
+        for action, call in budget_steps(parent_id, *family):
+            name = f'{action.__name__} (budget {action.statement_budget})'
+            try:
+                result = call()
+            except QueryBudgetExceeded as error:
+                db.session.rollback()
+                failed.append(name)
+                click.echo(f'OVER BUDGET: {error}')
+                continue
+            if not result:
+                failed.append(name)
+                click.echo(f'FAILED: {name} did nothing')
+            else:
+                click.echo(f'ok: {name}')
+    finally:
+        app.testing = testing
+        remove_family([parent_id])
+        db.session.commit()
+    if failed:
+        raise click.ClickException(f'{len(failed)} actions failed the budget check')
@@ -1,8 +1,19 @@
+from sqlite3 import Connection as SQLiteConnection
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 db = SQLAlchemy()
 
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """SQLite only enforces foreign keys, and their ON DELETE CASCADE, when
+    asked to on each connection. Family deletes rely on them"""
+
+    if isinstance(dbapi_connection, SQLiteConnection):
+        dbapi_connection.execute('PRAGMA foreign_keys = ON')
+
 class Parent(db.Model, UserMixin):
     """SQLAlchemy Parent model"""
 
@@ -13,20 +24,22 @@ class Parent(db.Model, UserMixin):
     password_hash = db.Column(db.String(256), nullable=False)
     # Establishes that account is a parent user
     type = db.Column(db.String(8), nullable=False, default='parent')
+    # Incremented whenever any of the family's data changes
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     # backref to child table
     children = db.relationship('Child', backref='parent', lazy='dynamic',
-        cascade='all, delete, delete-orphan')
+        cascade='all, delete, delete-orphan', passive_deletes=True)
     # backref to chores table
     chores = db.relationship('Chore', backref='parent', lazy='dynamic',
-        cascade='all, delete, delete-orphan')
+        cascade='all, delete, delete-orphan', passive_deletes=True)
 
     # backref to rewards table
     rewards = db.relationship('Reward', backref='parent', lazy='dynamic',
-        cascade='all, delete, delete-orphan')
+        cascade='all, delete, delete-orphan', passive_deletes=True)
 
     # backref to notifications table
     notifications = db.relationship('ParentNotification', backref='parent',
-        lazy='dynamic', cascade='all, delete, delete-orphan')
+        lazy='dynamic', cascade='all, delete, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f"{self.username}"
@@ -44,14 +57,23 @@ class Child(db.Model, UserMixin):
     type = db.Column(db.String(8), nullable=False, default='child')
     points = db.Column(db.Integer(), nullable=False, default=0)
     # backref to parents table
-    parent_id = db.Column(db.Integer(), db.ForeignKey('parent.id'), nullable=False)
+    parent_id = db.Column(db.Integer(), db.ForeignKey('parent.id', ondelete='CASCADE'),
+        nullable=False, index=True)
     # backref to assigned chores table
     assigned_chores = db.relationship('AssignedChore', backref='child',
-        lazy='dynamic', cascade='all, delete, delete-orphan')
+        lazy='dynamic', cascade='all, delete, delete-orphan', passive_deletes=True)
 
     # backref to notifications table
     notifications = db.relationship('ChildNotification', backref='child',
-        lazy='dynamic', cascade='all, delete, delete-orphan')
+        lazy='dynamic', cascade='all, delete, delete-orphan', passive_deletes=True)
+
+    # backref to chore schedules table
+    schedules = db.relationship('ChoreSchedule', backref='child',
+        lazy='dynamic', cascade='all, delete, delete-orphan', passive_deletes=True)
+
+    # backref to points ledger table
+    points_entries = db.relationship('PointsEntry', backref='child',
+        lazy='dynamic', cascade='all, delete, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f"{self.username}"
@@ -59,6 +81,28 @@ class Child(db.Model, UserMixin):
     def get_id(self):
         return str(self.username)
 
+class Account(db.Model):
+    """SQLAlchemy model indexing usernames across parent and child users"""
+
+    # Primary key enforces username uniqueness across both user tables
+    username = db.Column(db.String(64), primary_key=True)
+    # Possible types: parent, child
+    type = db.Column(db.String(8), nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey('parent.id', ondelete='CASCADE'),
+        nullable=True, unique=True)
+    child_id = db.Column(db.Integer, db.ForeignKey('child.id', ondelete='CASCADE'),
+        nullable=True, unique=True)
+    parent = db.relationship('Parent')
+    child = db.relationship('Child')
+
+    __table_args__ = (
+        db.CheckConstraint('(parent_id IS NULL) <> (child_id IS NULL)',
+            name='account_one_user'),
+    )
+
+    def __repr__(self):
+        return f"{self.username}"
+
 class Chore(db.Model):
     """SQLAlchemy model for created chores"""
 
@@ -66,10 +110,14 @@ class Chore(db.Model):
     name = db.Column(db.String(256), nullable=False, index=True)
     # Point value of task
     value = db.Column(db.Integer, nullable=False)
-    parent_id = db.Column(db.Integer, db.ForeignKey('parent.id'), nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey('parent.id', ondelete='CASCADE'),
+        nullable=False, index=True)
     # backref to Assigned_Chore table
     assigned_chores = db.relationship('AssignedChore', backref='chore',
-        lazy='dynamic', cascade='all, delete, delete-orphan')
+        lazy='dynamic', cascade='all, delete, delete-orphan', passive_deletes=True)
+    # backref to Chore_Schedule table
+    schedules = db.relationship('ChoreSchedule', backref='chore',
+        lazy='dynamic', cascade='all, delete, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f"{self.name}"
@@ -81,16 +129,89 @@ class AssignedChore(db.Model):
     # Possible states: Active, Complete, Rejected
     state = db.Column(db.String(24), nullable=False)
     # Chore that has been assigned
-    chore_id = db.Column(db.Integer, db.ForeignKey('chore.id'), nullable=False)
+    chore_id = db.Column(db.Integer, db.ForeignKey('chore.id', ondelete='CASCADE'),
+        nullable=False)
     # Child user that chore is assigned to
-    user_id = db.Column(db.Integer, db.ForeignKey('child.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('child.id', ondelete='CASCADE'),
+        nullable=False)
     # backref to Notifications table
     parent_notifications = db.relationship('ParentNotification',
         backref='assigned_chore', lazy='dynamic',
-        cascade='all, delete, delete-orphan')
+        cascade='all, delete, delete-orphan', passive_deletes=True)
     child_notifications = db.relationship('ChildNotification',
         backref='assigned_chore', lazy='dynamic',
-        cascade='all, delete, delete-orphan')
+        cascade='all, delete, delete-orphan', passive_deletes=True)
+
+    __table_args__ = (
+        # Ordered chore lists and per-child chore counts
+        db.Index('ix_assigned_chore_user_id_id', 'user_id', 'id'),
+        # Duplicate assignment checks
+        db.Index('ix_assigned_chore_user_id_chore_id', 'user_id', 'chore_id'),
+        # Removing assignments when a chore is deleted
+        db.Index('ix_assigned_chore_chore_id', 'chore_id'),
+    )
+
+class ChoreSchedule(db.Model):
+    """SQLAlchemy model for chores assigned to a child on a recurring schedule"""
+
+    id = db.Column(db.Integer, db.Identity(start=1), primary_key=True)
+    chore_id = db.Column(db.Integer, db.ForeignKey('chore.id', ondelete='CASCADE'),
+        nullable=False)
+    # Child user that chore is assigned to
+    user_id = db.Column(db.Integer, db.ForeignKey('child.id', ondelete='CASCADE'),
+        nullable=False, index=True)
+    # Bitmask of days chore is assigned on. Monday = 1, Sunday = 64
+    weekdays = db.Column(db.Integer, nullable=False)
+    # Last date assignments were generated for this schedule
+    last_run = db.Column(db.Date, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('chore_id', 'user_id'),
+    )
+
+class PointsEntry(db.Model):
+    """SQLAlchemy model for the append-only ledger of child point changes.
+    Child.points is the running total of a child's entries"""
+
+    __tablename__ = 'points_ledger'
+
+    id = db.Column(db.Integer, db.Identity(start=1), primary_key=True)
+    child_id = db.Column(db.Integer, db.ForeignKey('child.id', ondelete='CASCADE'),
+        nullable=False)
+    # Points added, negative when points are spent or removed
+    delta = db.Column(db.Integer, nullable=False)
+    # Child's points after this change
+    balance = db.Column(db.Integer, nullable=False)
+    reason = db.Column(db.String(256), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    __table_args__ = (
+        # Child's history in order, and reconciliation totals
+        db.Index('ix_points_ledger_child_id_id', 'child_id', 'id'),
+    )
+
+class ActivityLog(db.Model):
+    """SQLAlchemy model for the append-only history of chores and rewards"""
+
+    id = db.Column(db.Integer, db.Identity(start=1), primary_key=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('parent.id', ondelete='CASCADE'),
+        nullable=False)
+    # Child the activity belongs to. Kept with their name after the child is deleted
+    child_id = db.Column(db.Integer, nullable=True)
+    child_name = db.Column(db.String(64), nullable=False)
+    # Possible actions: completed, approved, rejected, purchased, delivered
+    action = db.Column(db.String(16), nullable=False)
+    # Name of chore or reward
+    item = db.Column(db.String(256), nullable=False)
+    # Points earned or spent, if any
+    points = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    __table_args__ = (
+        # Family history by month, newest first
+        db.Index('ix_activity_log_parent_id_created_at_id', 'parent_id', 'created_at',
+            'id'),
+    )
 
 class Reward(db.Model):
     """SQLAlchemy model for created rewards"""
@@ -98,12 +219,13 @@ class Reward(db.Model):
     id = db.Column(db.Integer, db.Identity(start=1), primary_key=True)
     name = db.Column(db.String(256), nullable=False, index=True)
     cost = db.Column(db.Integer, nullable=False)
-    parent_id = db.Column(db.Integer, db.ForeignKey('parent.id'), nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey('parent.id', ondelete='CASCADE'),
+        nullable=False, index=True)
     # backref to Notifications table
     parent_notifications = db.relationship('ParentNotification', backref='reward',
-        lazy='dynamic', cascade='all, delete, delete-orphan')
+        lazy='dynamic', cascade='all, delete, delete-orphan', passive_deletes=True)
     child_notifications = db.relationship('ChildNotification', backref='reward',
-        lazy='dynamic', cascade='all, delete, delete-orphan')
+        lazy='dynamic', cascade='all, delete, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return "{self.name}"
@@ -117,13 +239,34 @@ class ParentNotification(db.Model):
     # Message string for notification. Will include vars for Chore or Reward
     message = db.Column(db.String(256), nullable=False)
     # ID of parent user owning notification
-    parent_id = db.Column(db.Integer, db.ForeignKey('parent.id'), nullable=False)
+    parent_id = db.Column(db.Integer, db.ForeignKey('parent.id', ondelete='CASCADE'),
+        nullable=False)
     # ID of child user that notification references
-    child_id = db.Column(db.Integer, nullable=False)
+    child_id = db.Column(db.Integer, db.ForeignKey('child.id', ondelete='CASCADE'),
+        nullable=False)
     # References reward that notification relates to
-    reward_id = db.Column(db.Integer, db.ForeignKey('reward.id'), nullable=True)
+    reward_id = db.Column(db.Integer, db.ForeignKey('reward.id', ondelete='CASCADE'),
+        nullable=True)
     # References chore that notification relates to
-    chore_id = db.Column(db.Integer, db.ForeignKey('assigned_chore.id'), nullable=True)
+    chore_id = db.Column(db.Integer, db.ForeignKey('assigned_chore.id',
+        ondelete='CASCADE'), nullable=True, index=True)
+    # Set again when a chore notification is refreshed. Expired after
+    # NOTIFICATION_TTL_DAYS by the purge-notifications command
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    __table_args__ = (
+        # Ordered notification lists for parent dashboard
+        db.Index('ix_parent_notification_parent_id_id', 'parent_id', 'id'),
+        # Removing notifications when a child is deleted
+        db.Index('ix_parent_notification_child_id', 'child_id'),
+        db.Index('ix_parent_notification_reward_id', 'reward_id'),
+        # One notification per assigned chore and type. Reward notifications
+        # have no chore_id, so aren't limited
+        db.Index('uq_parent_notification_chore_id_parent_id_type', 'chore_id',
+            'parent_id', 'type', unique=True),
+        # Finding expired notifications
+        db.Index('ix_parent_notification_created_at', 'created_at'),
+    )
 
     def __repr__(self):
         return "{self.message}"
@@ -137,11 +280,28 @@ class ChildNotification(db.Model):
     # Message string for notification. Will include vars for Chore or Reward
     message = db.Column(db.String(256), nullable=False)    
     # ID of child user owning notification
-    child_id = db.Column(db.Integer, db.ForeignKey('child.id'), nullable=False)
+    child_id = db.Column(db.Integer, db.ForeignKey('child.id', ondelete='CASCADE'),
+        nullable=False)
     # References reward that notification relates to
-    reward_id = db.Column(db.Integer, db.ForeignKey('reward.id'), nullable=True)
+    reward_id = db.Column(db.Integer, db.ForeignKey('reward.id', ondelete='CASCADE'),
+        nullable=True)
     # References chore that notification relates to
-    chore_id = db.Column(db.Integer, db.ForeignKey('assigned_chore.id'), nullable=True)
+    chore_id = db.Column(db.Integer, db.ForeignKey('assigned_chore.id',
+        ondelete='CASCADE'), nullable=True, index=True)
+    # Set again when a chore notification is refreshed. Expired after
+    # NOTIFICATION_TTL_DAYS by the purge-notifications command
+    created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
+
+    __table_args__ = (
+        # Ordered notification lists for child home page
+        db.Index('ix_child_notification_child_id_id', 'child_id', 'id'),
+        db.Index('ix_child_notification_reward_id', 'reward_id'),
+        # One notification per assigned chore and type
+        db.Index('uq_child_notification_chore_id_child_id_type', 'chore_id',
+            'child_id', 'type', unique=True),
+        # Finding expired notifications
+        db.Index('ix_child_notification_created_at', 'created_at'),
+    )
 
     def __repr__(self):
         return "{self.message}"
\ No newline at end of file
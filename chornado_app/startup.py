@@ -0,0 +1,174 @@
+import re
+import subprocess
+import sys
+from os import makedirs, path
+from statistics import median
+from threading import Lock
+from time import perf_counter
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+# Run in a fresh interpreter to measure a cold start
+STARTUP_PROBE = ('import time; start = time.perf_counter(); '
+    'from chornado_app import create_app; create_app(); '
+    'print(round((time.perf_counter() - start) * 1000, 1))')
+
+# Line of python -X importtime output: self and cumulative microseconds,
+# then the module name indented by its import depth
+IMPORT_TIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+
+class WarmUp:
+    """Warm-up state of the app in one worker process"""
+
+    def __init__(self):
+        self.done = False
+        self._lock = Lock()
+
+def page_templates(app):
+    """Names of all HTML templates, including partials and base templates
+    Args: (app)"""
+
+    return [name for name in app.jinja_env.list_templates() if name.endswith('.html')]
+
+def precompile_templates(app):
+    """Compile every template into the Jinja environment's cache, and into
+    the bytecode cache if TEMPLATE_CACHE_DIR is set. Templates already in
+    the bytecode cache are loaded without compiling
+    Args: (app)
+    Returns: number of templates"""
+
+    names = page_templates(app)
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+def open_connections(app):
+    """Open up to DB_WARM_CONNECTIONS pooled database connections and
+    return them to the pool, so the first requests don't wait to connect
+    Args: (app)
+    Returns: number of connections opened"""
+
+    from .sql_models import db
+
+    with app.app_context():
+        engine = db.engine
+        count = app.config['DB_WARM_CONNECTIONS']
+        if isinstance(engine.pool, QueuePool):
+            count = min(count, engine.pool.size())
+        else:
+            # Connections aren't kept, but the first one sets up the dialect
+            count = min(count, 1)
+        connections = []
+        try:
+            for _ in range(count):
+                connections.append(engine.connect())
+        finally:
+            for connection in connections:
+                connection.close()
+    return count
+
+def warm_up(app):
+    """Compile templates and open database connections once per worker
+    process, before it reports healthy. Run by gunicorn's post_worker_init,
+    or by the first health check otherwise. A failed warm-up is retried
+    on the next call
+    Args: (app)
+    Returns: true if the app is warm"""
+
+    state = app.extensions['warm_up']
+    if state.done:
+        return True
+    with state._lock:
+        if state.done:
+            return True
+        start = perf_counter()
+        templates = precompile_templates(app)
+        try:
+            connections = open_connections(app)
+        except exc.SQLAlchemyError as error:
+            app.logger.warning('Warm-up could not connect to the database: %s', error)
+            return False
+        state.done = True
+    app.logger.info('Warmed up in %.0f ms: %d templates, %d connections',
+        (perf_counter() - start) * 1000, templates, connections)
+    return True
+
+def health_view():
+    """Health check for fly.io, failing until the worker has warmed up"""
+
+    if not warm_up(current_app._get_current_object()):
+        return 'Starting', 503
+    return 'OK'
+
+def init_startup(app):
+    """Use the template bytecode cache in TEMPLATE_CACHE_DIR if set, and
+    serve the health check at /healthz
+    Args: (app)"""
+
+    if app.config['TEMPLATE_CACHE_DIR']:
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+            app.config['TEMPLATE_CACHE_DIR'])
+    app.extensions['warm_up'] = WarmUp()
+    app.add_url_rule('/healthz', 'health', health_view)
+
+def measure_startup(root):
+    """Import the app and run create_app() in a fresh interpreter
+    Args: (root)
+        root: directory containing the chornado_app package
+    Returns: (create_app ms, import ms, dict of top level import to ms)"""
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_PROBE],
+        cwd=root, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise click.ClickException(f'create_app() failed:\n{result.stderr[-2000:]}')
+
+    imports = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        # Top level imports aren't indented, and their cumulative time
+        # includes everything they import
+        if match and not match.group(3):
+            imports[match.group(4)] = int(match.group(2)) / 1000
+    return float(result.stdout.split()[-1]), sum(imports.values()), imports
+
+@click.command('precompile-templates')
+@with_appcontext
+def precompile_templates_command():
+    """Fill TEMPLATE_CACHE_DIR with template bytecode. Run at build time"""
+
+    if not current_app.config['TEMPLATE_CACHE_DIR']:
+        raise click.ClickException('TEMPLATE_CACHE_DIR is not set')
+    makedirs(current_app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+    count = precompile_templates(current_app)
+    click.echo(f'{count} templates compiled to '
+        f'{current_app.config["TEMPLATE_CACHE_DIR"]}')
+
+@click.command('check-startup')
+@click.option('--budget', type=float, help='Most import time allowed in ms. '
+    'Defaults to IMPORT_TIME_BUDGET_MS.')
+@click.option('--runs', default=3, help='Cold starts to take the median of.')
+@click.option('--top', default=10, help='Slowest top level imports to list.')
+@with_appcontext
+def check_startup_command(budget, runs, top):
+    """Measure import time and create_app() in fresh interpreters against
+    the import time budget"""
+
+    if budget is None:
+        budget = current_app.config['IMPORT_TIME_BUDGET_MS']
+    root = path.dirname(current_app.root_path)
+    samples = [measure_startup(root) for _ in range(runs)]
+    # The run with the median import time
+    _, import_ms, imports = sorted(samples, key=lambda sample: sample[1])[
+        len(samples) // 2]
+
+    for name, ms in sorted(imports.items(), key=lambda item: -item[1])[:top]:
+        click.echo(f'{ms:>9.1f} ms  {name}')
+    click.echo(f'Imports: {import_ms:.0f} ms (median of {runs}, budget {budget:.0f} ms)')
+    click.echo(f'create_app(): {median(sample[0] for sample in samples):.0f} ms')
+    if import_ms > budget:
+        raise click.ClickException(f'Import time {import_ms:.0f} ms is over the '
+            f'{budget:.0f} ms budget')
@@ -0,0 +1,21 @@
+// Shows notifications pushed by the server without reloading the page
+(function () {
+    const container = document.getElementById('liveNotifications');
+    if (!container || !window.EventSource) {
+        return;
+    }
+    const list = container.querySelector('ul');
+    const source = new EventSource('/events');
+
+    source.onmessage = function (event) {
+        const data = JSON.parse(event.data);
+        if (data.type !== 'notification') {
+            return;
+        }
+        const item = document.createElement('li');
+        item.className = 'list-group-item notification';
+        item.textContent = data.message;
+        list.appendChild(item);
+        container.classList.remove('d-none');
+    };
+})();
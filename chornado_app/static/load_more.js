@@ -0,0 +1,29 @@
+// Appends the next page of a notification or chore list when its
+// "Load more" button is clicked, following X-Next-URL to the page after
+document.addEventListener('click', function (event) {
+    const button = event.target.closest('.load-more');
+    if (!button) {
+        return;
+    }
+    button.disabled = true;
+    fetch(button.dataset.url, {credentials: 'same-origin'})
+        .then(function (response) {
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            return response.text().then(function (html) {
+                document.getElementById(button.dataset.target)
+                    .insertAdjacentHTML('beforeend', html);
+                const next = response.headers.get('X-Next-URL');
+                if (next) {
+                    button.dataset.url = next;
+                    button.disabled = false;
+                } else {
+                    button.remove();
+                }
+            });
+        })
+        .catch(function () {
+            button.disabled = false;
+        });
+});
@@ -0,0 +1,286 @@
+import csv
+import json
+from collections import defaultdict, namedtuple
+from datetime import date, datetime
+from io import StringIO
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import exc, text
+
+from .sql_models import (db, Account, Parent, Child, Chore, AssignedChore,
+    ChoreSchedule, PointsEntry, Reward, ParentNotification, ChildNotification,
+    ActivityLog)
+
+# Rows fetched from the database, and inserted, at a time
+BATCH_SIZE = 1000
+
+# Table of a family export. references maps columns holding ids of other
+# exported rows to the table they point at
+FamilyTable = namedtuple('FamilyTable', ['name', 'model', 'columns', 'references'])
+
+# Tables in import order, so rows always come after the rows they reference
+FAMILY_TABLES = [
+    FamilyTable('parent', Parent,
+        ['id', 'username', 'first_name', 'last_name', 'password_hash'], {}),
+    FamilyTable('child', Child,
+        ['id', 'username', 'first_name', 'password_hash', 'points'], {}),
+    FamilyTable('chore', Chore, ['id', 'name', 'value'], {}),
+    FamilyTable('reward', Reward, ['id', 'name', 'cost'], {}),
+    FamilyTable('assigned_chore', AssignedChore, ['id', 'state', 'chore_id', 'user_id'],
+        {'chore_id': 'chore', 'user_id': 'child'}),
+    FamilyTable('chore_schedule', ChoreSchedule,
+        ['id', 'chore_id', 'user_id', 'weekdays', 'last_run'],
+        {'chore_id': 'chore', 'user_id': 'child'}),
+    FamilyTable('points_ledger', PointsEntry,
+        ['id', 'child_id', 'delta', 'balance', 'reason', 'created_at'],
+        {'child_id': 'child'}),
+    FamilyTable('parent_notification', ParentNotification,
+        ['id', 'type', 'message', 'child_id', 'reward_id', 'chore_id', 'created_at'],
+        {'child_id': 'child', 'reward_id': 'reward', 'chore_id': 'assigned_chore'}),
+    FamilyTable('child_notification', ChildNotification,
+        ['id', 'type', 'message', 'child_id', 'reward_id', 'chore_id', 'created_at'],
+        {'child_id': 'child', 'reward_id': 'reward', 'chore_id': 'assigned_chore'}),
+    FamilyTable('activity_log', ActivityLog,
+        ['id', 'child_id', 'child_name', 'action', 'item', 'points', 'created_at'],
+        {'child_id': 'child'}),
+]
+TABLES_BY_NAME = {table.name: table for table in FAMILY_TABLES}
+
+class FamilyImportError(Exception):
+    """Raised when an import file can't be loaded"""
+
+def family_filter(table, parent_id):
+    """WHERE clause selecting table's rows for a family
+    Args: (table, parent_id)"""
+
+    model = table.model
+    children = db.select(Child.id).where(Child.parent_id == parent_id)
+    if model is Parent:
+        return Parent.id == parent_id
+    if hasattr(model, 'parent_id'):
+        return model.parent_id == parent_id
+    if hasattr(model, 'user_id'):
+        return model.user_id.in_(children)
+    return model.child_id.in_(children)
+
+def family_rows(parent_id, include_passwords=True):
+    """Yield (table, row) for every row of a family, streamed from the
+    database with a server-side cursor
+    Args: (parent_id, include_passwords)"""
+
+    for table in FAMILY_TABLES:
+        columns = [column for column in table.columns
+            if include_passwords or column != 'password_hash']
+        statement = (db.select(*[getattr(table.model, column) for column in columns])
+            .where(family_filter(table, parent_id)).order_by(table.model.id)
+            .execution_options(yield_per=BATCH_SIZE))
+        for row in db.session.execute(statement):
+            yield table, dict(zip(columns, row))
+
+def to_text(value):
+    """JSON and CSV representation of a column value
+    Args: (value)"""
+
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+def export_ndjson(parent_id, include_passwords=True):
+    """Yield family as newline delimited JSON, one row per line
+    Args: (parent_id, include_passwords)"""
+
+    for table, row in family_rows(parent_id, include_passwords):
+        record = {'table': table.name}
+        record.update((column, to_text(value)) for column, value in row.items())
+        yield json.dumps(record) + '\n'
+
+def export_csv(parent_id, include_passwords=True):
+    """Yield family as CSV. Each table starts with a header row whose first
+    cell is 'table', and every data row starts with its table name
+    Args: (parent_id, include_passwords)"""
+
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    current = None
+    for table, row in family_rows(parent_id, include_passwords):
+        if table is not current:
+            writer.writerow(['table'] + list(row))
+            current = table
+        writer.writerow([table.name] + [to_text(value) for value in row.values()])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+EXPORT_FORMATS = {'ndjson': (export_ndjson, 'application/x-ndjson'),
+    'csv': (export_csv, 'text/csv')}
+
+def read_ndjson(lines):
+    """Yield records from NDJSON lines
+    Args: (lines)"""
+
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+def read_csv(lines):
+    """Yield records from a CSV export
+    Args: (lines)"""
+
+    header = None
+    for row in csv.reader(lines):
+        if not row:
+            continue
+        if row[0] == 'table':
+            header = row
+            continue
+        if header is None:
+            raise FamilyImportError('CSV row before the first table header')
+        yield {column: value for column, value in zip(header, row)}
+
+def from_text(model, column, value):
+    """Convert an exported value back to the column's Python type
+    Args: (model, column, value)"""
+
+    if value is None or value == '':
+        return None
+    python_type = getattr(model, column).type.python_type
+    if python_type is date and isinstance(value, str):
+        return date.fromisoformat(value)
+    if python_type is datetime and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return python_type(value)
+
+def allocate_ids(model, count):
+    """Reserve count new primary keys for model, so imported rows can be
+    inserted with their ids known beforehand
+    Args: (model, count)"""
+
+    name = model.__table__.name
+    if db.engine.dialect.name == 'postgresql':
+        return list(db.session.execute(text('SELECT nextval(pg_get_serial_sequence('
+            ':name, \'id\')) FROM generate_series(1, :count)'),
+            {'name': name, 'count': count}).scalars())
+    # Other databases run the import as their only writer
+    start = db.session.execute(db.select(db.func.max(model.id))).scalar() or 0
+    return list(range(start + 1, start + 1 + count))
+
+class FamilyImport:
+    """Loads records of one exported family as a new family, in batches of
+    multi-row INSERTs. Exported ids are replaced with new ones"""
+
+    def __init__(self):
+        self.ids = defaultdict(dict)
+        self.counts = defaultdict(int)
+
+    def load(self, records):
+        """Insert records, which must be in export order
+        Args: (records)"""
+
+        table, batch = None, []
+        for record in records:
+            record_table = TABLES_BY_NAME.get(record.get('table'))
+            if record_table is None:
+                raise FamilyImportError(f'Unknown table {record.get("table")}')
+            if record_table is not table or len(batch) >= BATCH_SIZE:
+                self.insert(table, batch)
+                table, batch = record_table, []
+            batch.append(record)
+        self.insert(table, batch)
+        if not self.ids['parent']:
+            raise FamilyImportError('No parent in import')
+        return self.counts
+
+    def parent_id(self):
+        if len(self.ids['parent']) != 1:
+            raise FamilyImportError('Import must contain exactly one parent')
+        return next(iter(self.ids['parent'].values()))
+
+    def insert(self, table, batch):
+        """Insert a batch of one table's records with new ids
+        Args: (table, batch)"""
+
+        if not batch:
+            return
+
+        columns = table.model.__table__.c
+        rows = []
+        for record, new_id in zip(batch, allocate_ids(table.model, len(batch))):
+            row = {column: from_text(table.model, column, record.get(column))
+                for column in table.columns if column != 'id'}
+            for column, target in table.references.items():
+                if row[column] is not None:
+                    # References to rows missing from the export become None
+                    row[column] = self.ids[target].get(row[column])
+            for column, value in list(row.items()):
+                # Columns missing from older exports take their default
+                if value is None and columns[column].server_default is not None:
+                    del row[column]
+                elif value is None and not columns[column].nullable:
+                    raise FamilyImportError(f'{table.name} {record.get("id")} '
+                        f'has no {column}')
+            if 'parent_id' in columns:
+                row['parent_id'] = self.parent_id()
+            row['id'] = new_id
+            self.ids[table.name][int(record['id'])] = new_id
+            rows.append(row)
+
+        db.session.execute(db.insert(table.model.__table__), rows)
+        if table.model in (Parent, Child):
+            db.session.execute(db.insert(Account.__table__),
+                [{'username': row['username'], 'type': table.name,
+                    f'{table.name}_id': row['id']} for row in rows])
+        self.counts[table.name] += len(rows)
+
+def read_records(file, file_format):
+    """Records of an export file in ndjson or csv format
+    Args: (file, file_format)"""
+
+    return read_csv(file) if file_format == 'csv' else read_ndjson(file)
+
+def file_format(filename, file_format):
+    """Export format given, or taken from the file extension
+    Args: (filename, file_format)"""
+
+    if file_format:
+        return file_format
+    return 'csv' if filename.endswith('.csv') else 'ndjson'
+
+@click.command('export-family')
+@click.argument('username')
+@click.option('--output', '-o', default='-', help='File to write, - for stdout.')
+@click.option('--format', 'export_format', type=click.Choice(list(EXPORT_FORMATS)),
+    help='Defaults to csv for .csv files, ndjson otherwise.')
+@with_appcontext
+def export_family_command(username, output, export_format):
+    """Export a parent's family, including password hashes"""
+
+    parent = Parent.query.filter_by(username=username).first()
+    if parent is None:
+        raise click.ClickException(f'No parent with username {username}')
+    export, _ = EXPORT_FORMATS[file_format(output, export_format)]
+    with click.open_file(output, 'w') as file:
+        for chunk in export(parent.id):
+            file.write(chunk)
+
+@click.command('import-family')
+@click.argument('file', type=click.File())
+@click.option('--format', 'import_format', type=click.Choice(list(EXPORT_FORMATS)),
+    help='Defaults to csv for .csv files, ndjson otherwise.')
+@with_appcontext
+def import_family_command(file, import_format):
+    """Import an exported family as a new family, in one transaction"""
+
+    family_import = FamilyImport()
+    try:
+        counts = family_import.load(read_records(file, file_format(file.name,
+            import_format)))
+        db.session.commit()
+    except (FamilyImportError, ValueError, KeyError) as error:
+        db.session.rollback()
+        raise click.ClickException(f'Import failed: {error}')
+    except exc.IntegrityError as error:
+        db.session.rollback()
+        raise click.ClickException(f'Import failed, check that the usernames are '
+            f'not taken: {error.orig}')
+    for name, count in counts.items():
+        click.echo(f'{name}: {count}')
@@ -0,0 +1,28 @@
+from os import environ
+
+# Worker processes per machine. create_app() reads the same variables to
+# size each worker's database pool
+workers = int(environ.get('WEB_CONCURRENCY', 2))
+# gevent workers keep serving other requests while one waits on Postgres
+# or holds an event stream open. Set to sync or gthread to disable
+worker_class = environ.get('WEB_WORKER_CLASS', 'gevent')
+# Concurrent requests per gevent worker, matching hard_limit in fly.toml
+worker_connections = int(environ.get('WEB_WORKER_CONNECTIONS', 25))
+# Threads per gthread worker
+threads = int(environ.get('WEB_THREADS', 1))
+
+def post_fork(server, worker):
+    """Make psycopg2 wait on sockets through gevent, so a query only
+    blocks its own greenlet"""
+
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+def post_worker_init(worker):
+    """Compile templates and open database connections before the worker
+    accepts requests, so the first ones after a cold start don't pay for
+    them. /healthz fails until this has succeeded"""
+
+    from chornado_app.startup import warm_up
+    warm_up(worker.wsgi)